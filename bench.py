@@ -0,0 +1,265 @@
+"""
+Офлайн навантажувальний тест шляху пересилання (channel_post_handler -> outbox -> scheduler).
+
+1) Генерує синтетичну channels.db: N користувачів, M груп на користувача, K каналів у групі,
+   частка «спільних» каналів/цілей між групами (overlap).
+2) Жене channel_post_handler синтетичними Update'ами проти stub-бота, який записує виклики
+   і вміє додавати затримку та RetryAfter.
+3) Друкує пропускну здатність, p50/p99 затримки хендлера, час у БД і end-to-end статистику.
+
+Мережа не потрібна. Приклад:
+    python bench.py --users 200 --groups 5 --channels 20 --overlap 0.3 --posts 5000 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн бенчмарк пересилання постів")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=5, help="груп на користувача")
+    parser.add_argument("--channels", type=int, default=20, help="каналів у групі")
+    parser.add_argument("--overlap", type=float, default=0.3,
+                        help="частка каналів/цілей, що береться зі спільного пулу (0..1)")
+    parser.add_argument("--posts", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="скільки апдейтів обробляти одночасно (1 = як PTB за замовчуванням)")
+    parser.add_argument("--latency", type=float, default=0.0, help="затримка stub-бота на запит, с")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="ймовірність RetryAfter на запит")
+    parser.add_argument("--album-share", type=float, default=0.0, help="частка постів, що є альбомами по 3")
+    parser.add_argument("--target-rate", type=float, default=1e9,
+                        help="ліміт на ціль, повідомлень/хв (за замовчуванням ліміти вимкнено)")
+    parser.add_argument("--global-rate", type=float, default=1e9, help="глобальний ліміт, повідомлень/с")
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", default=None, help="шлях до БД (за замовчуванням тимчасовий файл)")
+    return parser.parse_args()
+
+
+args = parse_args()
+random.seed(args.seed)
+
+# bot.py читає конфіг із середовища під час імпорту
+workdir = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ["DB_PATH"] = args.db or os.path.join(workdir, "channels.db")
+os.environ["FORWARD_TARGET_RATE_PER_MIN"] = str(args.target_rate)
+os.environ["FORWARD_TARGET_BURST"] = str(int(min(args.target_rate, 1e6)))
+os.environ["FORWARD_GLOBAL_RATE"] = str(args.global_rate)
+os.environ.setdefault("ALBUM_WINDOW", "0.05")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import logging                          # noqa: E402
+import bot                              # noqa: E402
+from telegram import Chat, Message, Update, MessageId   # noqa: E402
+from telegram.error import RetryAfter   # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+# ------------------------------------------------------------------------------------
+#                         СИНТЕТИЧНА БАЗА
+# ------------------------------------------------------------------------------------
+
+def generate_db(conn):
+    """Заповнює базу; повертає список chat_id каналів-джерел."""
+    bot.init_db(conn)
+    total_groups = args.users * args.groups
+    shared_channels = [-1001000000000 - i for i in range(max(1, args.channels * 4))]
+    shared_targets = [-1002000000000 - i for i in range(max(1, total_groups // 10))]
+    next_channel = -1003000000000
+    next_target = -1004000000000
+
+    groups, channels = [], []
+    group_id = 0
+    for user_id in range(1, args.users + 1):
+        for g in range(args.groups):
+            group_id += 1
+            if random.random() < args.overlap:
+                target = random.choice(shared_targets)
+            else:
+                next_target -= 1
+                target = next_target
+            groups.append((group_id, user_id, f"group-{g}", str(target), target))
+            picked = set()
+            for _ in range(args.channels):
+                if random.random() < args.overlap:
+                    picked.add(random.choice(shared_channels))
+                else:
+                    next_channel -= 1
+                    picked.add(next_channel)
+            channels += [(group_id, str(c), c) for c in picked]
+
+    conn.executemany(
+        "INSERT INTO groups (id, user_id, name, target_channel, target_chat_id) VALUES (?, ?, ?, ?, ?)", groups
+    )
+    conn.executemany("INSERT INTO group_channels (group_id, channel, chat_id) VALUES (?, ?, ?)", channels)
+    return sorted({c for (_, _, c) in channels})
+
+
+# ------------------------------------------------------------------------------------
+#                         STUB BOT
+# ------------------------------------------------------------------------------------
+
+class StubBot:
+    """Записує пересилання, імітує мережеву затримку та RetryAfter."""
+
+    def __init__(self):
+        self.forwarded = 0
+        self.requests = 0
+        self.retry_afters = 0
+        self.api_latency: list[float] = []
+        self.done = asyncio.Event()
+        self.expected = None
+
+    async def _call(self, count: int):
+        self.requests += 1
+        started = time.perf_counter()
+        if args.latency:
+            await asyncio.sleep(args.latency)
+        if args.retry_after and random.random() < args.retry_after:
+            self.retry_afters += 1
+            raise RetryAfter(1)
+        self.api_latency.append(time.perf_counter() - started)
+        self.forwarded += count
+        if self.expected is not None and self.forwarded >= self.expected:
+            self.done.set()
+
+    async def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._call(1)
+        return MessageId(message_id)
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids, **kwargs):
+        await self._call(len(message_ids))
+        return tuple(MessageId(m) for m in message_ids)
+
+    async def get_chat(self, chat_id, **kwargs):
+        await self._call(0)
+        return Chat(id=chat_id if isinstance(chat_id, int) else -1, type=Chat.CHANNEL)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call(0)
+
+
+# ------------------------------------------------------------------------------------
+#                         ПРОГІН
+# ------------------------------------------------------------------------------------
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def fmt_ms(values: list[float]) -> str:
+    if not values:
+        return "—"
+    return (f"p50={statistics.median(values) * 1000:.2f} мс  p99={percentile(values, 0.99) * 1000:.2f} мс  "
+            f"max={max(values) * 1000:.2f} мс")
+
+
+def make_posts(sources: list[int]) -> list[Update]:
+    now = datetime.now(timezone.utc)
+    message_ids = {}
+    updates = []
+    update_id = 0
+    while len(updates) < args.posts:
+        chat = Chat(id=random.choice(sources), type=Chat.CHANNEL, title="bench")
+        album = random.random() < args.album_share
+        media_group_id = f"mg{update_id}" if album else None
+        for _ in range(3 if album else 1):
+            message_ids[chat.id] = message_ids.get(chat.id, 0) + 1
+            update_id += 1
+            post = Message(message_ids[chat.id], now, chat, text="bench", media_group_id=media_group_id)
+            updates.append(Update(update_id, channel_post=post))
+    return updates
+
+
+async def run():
+    db_times: list[float] = []
+    original_call = bot.db._call
+
+    def timed_call(fn, fn_args):
+        started = time.perf_counter()
+        try:
+            return original_call(fn, fn_args)
+        finally:
+            db_times.append(time.perf_counter() - started)
+
+    bot.db._call = timed_call
+
+    started = time.perf_counter()
+    sources = await bot.db.run(generate_db)
+    await bot.db.run(bot.routing.load)
+    setup_time = time.perf_counter() - started
+    db_times.clear()
+
+    stub = StubBot()
+    bot.scheduler.start(stub)
+    bot.outbox.start()
+    context = type("Context", (), {"bot": stub})()
+
+    updates = make_posts(sources)
+    # Скільки пересилань очікуємо (після дедуплікації цілей)
+    stub.expected = sum(
+        len({t for (_, _, t) in bot.routing.lookup(u.channel_post.chat.id, None) if t}) for u in updates
+    )
+
+    handler_times: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(update: Update):
+        async with semaphore:
+            t = time.perf_counter()
+            await bot.channel_post_handler(update, context)
+            handler_times.append(time.perf_counter() - t)
+
+    intake_started = time.perf_counter()
+    if args.concurrency == 1:
+        for update in updates:
+            await handle(update)
+    else:
+        await asyncio.gather(*map(handle, updates))
+    intake_time = time.perf_counter() - intake_started
+
+    if stub.expected:
+        try:
+            await asyncio.wait_for(stub.done.wait(), args.drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+    total_time = time.perf_counter() - intake_started
+    await bot.albums.flush_all()
+    await bot.outbox.stop()
+
+    total_groups = args.users * args.groups
+    print("=" * 72)
+    print(f"БД: {total_groups} груп, {len(sources)} унікальних каналів, overlap={args.overlap}, "
+          f"підготовка {setup_time:.2f} с")
+    print(f"Постів: {len(updates)}, concurrency={args.concurrency}, затримка stub={args.latency * 1000:.0f} мс, "
+          f"RetryAfter={args.retry_after:.0%}")
+    print("-" * 72)
+    print(f"Прийом:        {len(updates) / intake_time:10.1f} постів/с")
+    print(f"Хендлер:       {fmt_ms(handler_times)}")
+    print(f"БД (на виклик): {fmt_ms(db_times)}  всього {sum(db_times):.2f} с за {len(db_times)} викликів")
+    print(f"Telegram API:  {fmt_ms(stub.api_latency)}")
+    print(f"Пересилання:   {stub.forwarded}/{stub.expected} за {total_time:.2f} с "
+          f"({stub.forwarded / total_time:.1f}/с), запитів {stub.requests}, RetryAfter {stub.retry_afters}")
+    print("=" * 72)
+
+
+def main():
+    try:
+        asyncio.run(run())
+    finally:
+        bot.db.close()
+
+
+if __name__ == "__main__":
+    main()
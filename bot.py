@@ -1,8 +1,36 @@
+import io
 import os
+import csv
+import sys
+import re
+import json
+import time
+import zlib
+import gc
+import hashlib
+import pickle
+import signal
+import bisect
+import functools
+import tempfile
+import threading
+import random
+import asyncio
 import sqlite3
+import atexit
 import logging
+import multiprocessing
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from telegram import (
+    Bot,
+    Chat,
     Update,
+    ChatMember,
+    LinkPreviewOptions,
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineKeyboardButton,
@@ -15,15 +43,120 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters,
     ContextTypes,
-    ConversationHandler
+    ConversationHandler,
+    ChatMemberHandler,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput
 )
+from telegram.error import RetryAfter, TelegramError, Forbidden, BadRequest, ChatMigrated
+from telegram.request import HTTPXRequest
+import re2
 
 # СТАНИ (ConversationHandler)
-MAIN_MENU, ADDING_GROUP, REMOVING_GROUP, GROUP_MENU, ADDING_CHANNEL, REMOVING_CHANNEL, SETTING_TARGET = range(7)
+(MAIN_MENU, ADDING_GROUP, REMOVING_GROUP, GROUP_MENU, ADDING_CHANNEL, REMOVING_CHANNEL, SETTING_TARGET,
+ EDITING_FILTERS, SETTING_DIGEST) = range(9)
 
-# Логування
-logging.basicConfig(level=logging.INFO)
+# ------------------------------------------------------------------------------------
+#                         ЛОГУВАННЯ
+# ------------------------------------------------------------------------------------
+
+# Запис у stderr/файл робить окремий потік (QueueListener): код, що логує, лише кладе запис
+# у чергу, тож повільний термінал чи диск не блокує event loop
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")        # text | json (по об'єкту на рядок)
+LOG_FILE = os.getenv("LOG_FILE")                    # додатково писати у файл
+# Рядки про окремі пости (logger forward_log, рівень DEBUG): не більше LOG_SAMPLE_BURST
+# на групу/ціль за LOG_SAMPLE_WINDOW секунд, решта лише підраховується
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "60"))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "5"))
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler, що не форматує запис у потоці, який логує (стандартний prepare() робить
+    msg % args одразу). Форматування відбувається в потоці QueueListener'а; аргументи
+    логування тут — числа, рядки та списки, які після виклику вже не змінюються.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Пропускає не більше burst записів з тим самим шаблоном і першим аргументом (група, ціль)
+    за window секунд. Кількість пропущених дописується до першого запису наступного вікна.
+    """
+
+    def __init__(self, window: float, burst: int):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.started = time.monotonic()
+        self.counts: dict[tuple, int] = {}
+        self.dropped: dict[tuple, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        if now - self.started >= self.window:
+            # Нове вікно: лічильники з нуля, пам'ять обмежена ключами одного вікна
+            self.started = now
+            self.dropped = {k: n - self.burst for (k, n) in self.counts.items() if n > self.burst}
+            self.counts = {}
+        key = (record.msg, record.args[0] if record.args else None)
+        count = self.counts[key] = self.counts.get(key, 0) + 1
+        if count > self.burst:
+            return False
+        dropped = self.dropped.pop(key, 0)
+        if dropped:
+            record.msg = f"{record.msg} (ще %d подібних пропущено)"
+            record.args = (*record.args, dropped)
+        return True
+
+
+def setup_logging() -> QueueListener:
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(records)]
+    root.setLevel(LOG_LEVEL)
+    # httpx пише INFO-рядок на кожен запит до Bot API, тобто на кожне пересилання
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    # Черга дописується до кінця при виході з процесу
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+forward_log = logging.getLogger(f"{__name__}.forward")
+forward_log.addFilter(RateLimitFilter(LOG_SAMPLE_WINDOW, LOG_SAMPLE_BURST))
 
 # Читаємо токен
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -32,16 +165,767 @@ if not BOT_TOKEN:
     exit(1)
 
 # Шлях до бази
-DB_PATH = "channels.db"
+DB_PATH = os.getenv("DB_PATH", "channels.db")
+
+
+# ------------------------------------------------------------------------------------
+#                         ІНДЕКС МАРШРУТИЗАЦІЇ (у пам'яті)
+# ------------------------------------------------------------------------------------
+
+class RoutingIndex:
+    """
+    Індекс маршрутизації у пам'яті: канал -> групи, куди він входить.
+    Ключ каналу — числовий chat_id; лише для ще не розпізнаних старих рядків це
+    збережений текст (@username або id рядком).
+    Будується один раз при старті з таблиць groups/group_channels і далі оновлюється
+    інкрементально з *_db-функцій, тож channel_post_handler не ходить у базу на кожен пост.
+    """
+
+    def __init__(self):
+        self.by_channel: dict[int|str, set[int]] = {}           # канал -> {group_id}
+        self.groups: dict[int, tuple[str, str|None]] = {}       # group_id -> (name, target)
+        self.channels_of: dict[int, set[int|str]] = {}          # group_id -> {канал}
+        self.failed: set[int] = set()       # групи, чий target остаточно недоступний (groups.target_error)
+        self.version = 0        # зростає при зміні target'ів — для кешів, похідних від groups
+
+    def load(self, conn: sqlite3.Connection):
+        """Повністю перебудовує індекс з бази (викликається при старті, у потоці БД)."""
+        self.by_channel.clear()
+        self.groups.clear()
+        self.channels_of.clear()
+        self.failed.clear()
+
+        c = conn.cursor()
+        c.execute("SELECT id, name, target_channel, target_chat_id, target_error FROM groups")
+        for (g_id, g_name, g_target, g_target_id, g_error) in c.fetchall():
+            self.add_group(g_id, g_name)
+            self.set_target(g_id, target_key(g_target, g_target_id))
+            if g_error is not None:
+                self.failed.add(g_id)
+        # JOIN відсікає «осиротілі» рядки group_channels від видалених груп
+        c.execute("""
+            SELECT gc.group_id, gc.channel, gc.chat_id FROM group_channels gc
+              JOIN groups g ON g.id = gc.group_id
+        """)
+        for (g_id, channel, chat_id) in c.fetchall():
+            self.add_channel(g_id, chat_id if chat_id is not None else channel)
+        logger.info("Індекс маршрутизації: %d груп, %d каналів.", len(self.groups), len(self.by_channel))
+
+    def warm_start(self, conn: sqlite3.Connection):
+        """
+        Старт зі знімка: якщо groups/group_channels не змінювались після його збереження
+        (покоління у routing_meta збігається), індекс відновлюється одним blob'ом замість
+        перебору всіх рядків. Інакше — повна перебудова з таблиць і новий знімок.
+        """
+        row = conn.execute("""
+            SELECT s.generation, s.data, m.generation FROM routing_snapshot s, routing_meta m
+        """).fetchone()
+        if row and row[0] == row[2]:
+            # Сотні тисяч дрібних set'ів поспіль раз у раз запускають циклічний GC, який
+            # обходить їх усі знову; без нього відновлення в кілька разів швидше
+            gc.disable()
+            try:
+                if self._restore(json.loads(zlib.decompress(row[1]))):
+                    logger.info("Індекс маршрутизації зі знімка: %d груп, %d каналів.",
+                                len(self.groups), len(self.by_channel))
+                    return
+            except Exception as e:
+                logger.warning("Знімок індексу маршрутизації пошкоджено, перебудовуємо: %s", e)
+            finally:
+                gc.enable()
+        self.load(conn)
+        self.save_snapshot(conn)
+
+    def _restore(self, data: dict) -> bool:
+        """
+        Відновлює індекс із JSON-знімка: лише прості дані (числа, рядки, списки),
+        тож вміст файлу бази не може виконати код при старті. False — знімок іншої версії.
+        """
+        if data.get("version") != ROUTING_SNAPSHOT_VERSION:
+            return False
+        groups, by_channel, channels_of, failed = {}, {}, {}, set()
+        for (g_id, name, target, is_failed, channels) in data["groups"]:
+            groups[g_id] = (name, target)
+            channels_of[g_id] = set(channels)
+            for channel in channels:
+                by_channel.setdefault(channel, set()).add(g_id)
+            if is_failed:
+                failed.add(g_id)
+        self.groups, self.by_channel, self.channels_of, self.failed = groups, by_channel, channels_of, failed
+        return True
+
+    def save_snapshot(self, conn: sqlite3.Connection):
+        """Зберігає індекс разом із поколінням таблиць, з якого він актуальний (у потоці БД)."""
+        (generation,) = conn.execute("SELECT generation FROM routing_meta").fetchone()
+        # by_channel — обернений channels_of, тож у знімок іде лише група з її каналами
+        data = json.dumps({
+            "version": ROUTING_SNAPSHOT_VERSION,
+            "groups": [
+                (g_id, name, target, g_id in self.failed, list(self.channels_of.get(g_id, ())))
+                for (g_id, (name, target)) in self.groups.items()
+            ],
+        }, ensure_ascii=False, separators=(",", ":")).encode()
+        conn.execute(
+            "INSERT OR REPLACE INTO routing_snapshot (id, generation, data, created_at) VALUES (1, ?, ?, ?)",
+            (generation, zlib.compress(data, 1), time.time())
+        )
+
+    def add_group(self, group_id: int, name: str):
+        self.groups[group_id] = (name, None)
+        self.channels_of.setdefault(group_id, set())
+
+    def remove_group(self, group_id: int):
+        self.version += 1
+        self.groups.pop(group_id, None)
+        self.failed.discard(group_id)
+        for channel in self.channels_of.pop(group_id, set()):
+            self._unlink(group_id, channel)
+
+    def set_target(self, group_id: int, target: str|None):
+        """Лише адреса: позначку недоступності знімає set_failed(..., False) разом з groups.target_error."""
+        self.version += 1
+        if group_id in self.groups:
+            name, _ = self.groups[group_id]
+            self.groups[group_id] = (name, target)
+
+    def set_failed(self, group_ids, failed: bool = True):
+        """Виключає групи з маршрутизації (або повертає), не чіпаючи їхніх каналів і target'у."""
+        self.version += 1
+        if failed:
+            self.failed.update(g_id for g_id in group_ids if g_id in self.groups)
+        else:
+            self.failed.difference_update(group_ids)
+
+    def groups_with_target(self, target: str) -> list[int]:
+        return [g_id for (g_id, (_, g_target)) in self.groups.items() if g_target == target]
+
+    def add_channel(self, group_id: int, channel: int|str):
+        self.by_channel.setdefault(channel, set()).add(group_id)
+        self.channels_of.setdefault(group_id, set()).add(channel)
+
+    def remove_channel(self, group_id: int, channel: int|str):
+        self.channels_of.get(group_id, set()).discard(channel)
+        self._unlink(group_id, channel)
+
+    def _unlink(self, group_id: int, channel: int|str):
+        groups = self.by_channel.get(channel)
+        if groups is not None:
+            groups.discard(group_id)
+            if not groups:
+                del self.by_channel[channel]
+
+    def lookup(self, channel_id: int, username: str|None) -> list[tuple[int, str, str|None]]:
+        """Повертає [(group_id, name, target)] для каналу за його id (та старими текстовими ключами)."""
+        group_ids = self.by_channel.get(channel_id, set())
+        # Старі рядки, які ще не вдалося перевести на chat_id
+        legacy = self.by_channel.get(str(channel_id))
+        if legacy:
+            group_ids = group_ids | legacy
+        if username:
+            legacy = self.by_channel.get(f"@{username}")
+            if legacy:
+                group_ids = group_ids | legacy
+        return [
+            (g_id, *self.groups[g_id]) for g_id in group_ids if g_id in self.groups and g_id not in self.failed
+        ]
+
+
+def target_key(target_channel: str|None, target_chat_id: int|None) -> str|None:
+    """Адреса для відправки: числовий chat_id (рядком), якщо відомий, інакше збережений текст."""
+    return str(target_chat_id) if target_chat_id is not None else target_channel
+
+
+ROUTING_SNAPSHOT_VERSION = 3      # збільшувати при зміні структури RoutingIndex або формату знімка
+
+routing = RoutingIndex()
+
+
+# ------------------------------------------------------------------------------------
+#                         ФІЛЬТРИ КОНТЕНТУ (правила груп, у пам'яті)
+# ------------------------------------------------------------------------------------
+
+FILTER_KINDS = ("keyword", "regex", "media")
+FILTER_MODES = ("include", "exclude")
+# Типи вмісту для правил media (animation перевіряємо раніше за document — у GIF заповнені обидва)
+MEDIA_KINDS = ("photo", "video", "animation", "document", "audio", "voice", "video_note",
+               "sticker", "poll", "location", "contact", "text")
+FILTER_MAX_RULES = 100          # правил на групу
+FILTER_MAX_PATTERN = 200        # символів у ключовому слові / regex
+# Regex-правила всіх груп виконуються одним RE2 Set за лінійний час, тож обмежуємо їх загальну кількість
+FILTER_MAX_REGEX = int(os.getenv("FILTER_MAX_REGEX", "1000"))
+REGEX_MAX_MEM = 64 << 20        # байтів на компіляцію і DFA спільного Set
+
+
+def post_kinds(message) -> set[str]:
+    """Типи вмісту поста: {'photo'}, {'video'}, ... або {'text'} для звичайного тексту."""
+    kinds = {kind for kind in MEDIA_KINDS[:-1] if getattr(message, kind, None)}
+    if "animation" in kinds:
+        kinds.discard("document")
+    return kinds or {"text"}
+
+
+def regex_options() -> re2.Options:
+    """Опції RE2 для regex-правил: без урахування регістру, з запасом пам'яті для спільного Set."""
+    options = re2.Options()
+    options.case_sensitive = False
+    options.log_errors = False
+    options.max_mem = REGEX_MAX_MEM
+    return options
+
+
+def validate_regex(pattern: str) -> str|None:
+    """Повертає текст помилки, якщо pattern не компілюється в RE2."""
+    try:
+        re2.compile(pattern, regex_options())
+    except re2.error as e:
+        message = e.args[0] if e.args else "некоректний regex"
+        return message.decode("utf-8", "replace") if isinstance(message, bytes) else str(message)
+    return None
+
+
+class AhoCorasick:
+    """
+    Автомат Ахо-Корасік для пошуку всіх ключових слів за один прохід по тексту.
+    Додавання/видалення слова змінює лише його шлях у trie; суфіксні посилання
+    перераховуються ліниво (один BFS) перед першим пошуком після змін.
+    """
+
+    def __init__(self):
+        self.goto: list[dict[str, int]] = [{}]
+        self.out: list[set[int]] = [set()]          # вузол -> правила, чиє слово тут закінчується
+        self.fail: list[int] = [0]
+        self.report: list[int] = [0]                # найближчий суфікс-вузол з непорожнім out
+        self.dirty = False
+
+    def add(self, word: str, rule_id: int):
+        node = 0
+        for ch in word:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = self.goto[node][ch] = len(self.goto)
+                self.goto.append({})
+                self.out.append(set())
+                self.fail.append(0)
+                self.report.append(0)
+            node = nxt
+        self.out[node].add(rule_id)
+        self.dirty = True
+
+    def remove(self, word: str, rule_id: int):
+        node = 0
+        for ch in word:
+            node = self.goto[node].get(ch)
+            if node is None:
+                return
+        self.out[node].discard(rule_id)
+        self.dirty = True
+
+    def _link(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            self.fail[node] = 0
+        for node in queue:      # queue росте під час обходу — це і є BFS
+            for (ch, child) in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                queue.append(child)
+        for node in queue:
+            f = self.fail[node]
+            self.report[node] = f if self.out[f] else self.report[f]
+        self.dirty = False
+
+    def search(self, text: str) -> set[int]:
+        if self.dirty:
+            self._link()
+        found = set()
+        goto, fail, out, report = self.goto, self.fail, self.out, self.report
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if out[node] else report[node]
+            while hit:
+                found |= out[hit]
+                hit = report[hit]
+        return found
+
+
+class ContentFilters:
+    """
+    Усі активні правила всіх груп, зібрані в один matcher: ключові слова — в автомат
+    Ахо-Корасік, media — у словник тип -> правила, regex — в один RE2 Set.
+    RE2 шукає за лінійний від довжини тексту час, тож жоден regex не зависне на бектрекінгу,
+    а текст поста проходить автомат і Set по одному разу незалежно від кількості груп і правил.
+    Як і RoutingIndex, будується при старті й далі оновлюється з *_db-функцій.
+    """
+
+    def __init__(self):
+        self.rules: dict[int, tuple[int, str, str, str]] = {}   # rule_id -> (group_id, kind, mode, pattern)
+        self.by_group: dict[int, set[int]] = {}
+        self.includes: dict[int, int] = {}                       # group_id -> кількість include-правил
+        self.keywords = AhoCorasick()
+        self.media: dict[str, set[int]] = {}
+        self.regexes: dict[int, str] = {}                       # rule_id -> regex
+        self.regex: re2.Set|None = None
+        self.regex_ids: list[int] = []                          # індекс у Set -> rule_id
+        self.regex_dirty = False
+
+    def load(self, conn: sqlite3.Connection):
+        self.__init__()
+        for (rule_id, group_id, kind, mode, pattern) in conn.execute(
+            "SELECT id, group_id, kind, mode, pattern FROM group_filters"
+        ):
+            # Regex'и, збережені до переходу на RE2 і не сумісні з ним, не вмикаємо (вони лишаються в /filters)
+            if kind == "regex" and (problem := validate_regex(pattern)):
+                logger.warning("Фільтр %s вимкнено: %s", rule_id, problem)
+                continue
+            self.add_rule(rule_id, group_id, kind, mode, pattern)
+        logger.info("Фільтри контенту: %d правил у %d групах.", len(self.rules), len(self.by_group))
+
+    def add_rule(self, rule_id: int, group_id: int, kind: str, mode: str, pattern: str):
+        self.rules[rule_id] = (group_id, kind, mode, pattern)
+        self.by_group.setdefault(group_id, set()).add(rule_id)
+        if mode == "include":
+            self.includes[group_id] = self.includes.get(group_id, 0) + 1
+        if kind == "keyword":
+            self.keywords.add(pattern.casefold(), rule_id)
+        elif kind == "media":
+            self.media.setdefault(pattern, set()).add(rule_id)
+        else:
+            self.regexes[rule_id] = pattern
+            self.regex_dirty = True
+
+    def remove_rule(self, rule_id: int):
+        rule = self.rules.pop(rule_id, None)
+        if rule is None:
+            return
+        group_id, kind, mode, pattern = rule
+        self.by_group[group_id].discard(rule_id)
+        if not self.by_group[group_id]:
+            del self.by_group[group_id]
+        if mode == "include":
+            self.includes[group_id] -= 1
+            if not self.includes[group_id]:
+                del self.includes[group_id]
+        if kind == "keyword":
+            self.keywords.remove(pattern.casefold(), rule_id)
+        elif kind == "media":
+            self.media[pattern].discard(rule_id)
+        else:
+            del self.regexes[rule_id]
+            self.regex_dirty = True
+
+    def remove_group(self, group_id: int):
+        for rule_id in list(self.by_group.get(group_id, ())):
+            self.remove_rule(rule_id)
+
+    def match(self, text: str, kinds: set[str]) -> set[int]:
+        """Правила (усіх груп), яким відповідає пост."""
+        matched = set()
+        for kind in kinds:
+            matched |= self.media.get(kind, set())
+        if text:
+            matched |= self.keywords.search(text.casefold())
+            if self.regex_dirty:
+                self._compile_regex()
+            if self.regex:
+                matched.update(self.regex_ids[i] for i in self.regex.Match(text) or ())
+        return matched
+
+    def _compile_regex(self):
+        """Перезбирає спільний RE2 Set після змін regex-правил (лише з match, тобто ліниво)."""
+        self.regex_dirty = False
+        self.regex, self.regex_ids = None, list(self.regexes)
+        if not self.regex_ids:
+            return
+        regex = re2.Set.SearchSet(regex_options())
+        try:
+            for pattern in self.regexes.values():
+                regex.Add(pattern)
+            regex.Compile()
+        except re2.error as e:
+            # Лише якщо правила разом не влізли в REGEX_MAX_MEM: кожне окремо вже перевірене
+            logger.error("Regex-фільтри вимкнено: %s", e)
+            return
+        self.regex = regex
+
+    def allowed(self, group_ids, text: str, kinds: set[str]) -> set[int]:
+        """
+        Групи, до яких пост проходить: жодне exclude-правило не спрацювало і,
+        якщо в групи є include-правила, спрацювало хоча б одне з них.
+        """
+        group_ids = set(group_ids)
+        filtered = group_ids & self.by_group.keys()
+        if not filtered:
+            return group_ids        # у цих груп правил немає — текст навіть не скануємо
+        hits: dict[int, set[str]] = {}
+        for rule_id in self.match(text, kinds):
+            group_id, _, mode, _ = self.rules[rule_id]
+            hits.setdefault(group_id, set()).add(mode)
+        allowed = group_ids - filtered
+        for group_id in filtered:
+            modes = hits.get(group_id, ())
+            if "exclude" in modes:
+                continue
+            if group_id in self.includes and "include" not in modes:
+                continue
+            allowed.add(group_id)
+        return allowed
+
+
+content_filters = ContentFilters()
+
+
+# ------------------------------------------------------------------------------------
+#                         МЕТРИКИ (Prometheus text exposition)
+# ------------------------------------------------------------------------------------
+
+# Локальний HTTP-порт для /metrics і /debug/profile/*; 0 — вимкнено
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """Базова метрика з мітками; оновлюється і з event loop, і з потоку БД, тому під lock'ом."""
+
+    kind = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+        registry.append(self)
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        parts = []
+        for (k, v) in key + extra:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{v}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def drain(self) -> dict[tuple, object]:
+        """Забирає накопичені значення й обнуляє метрику (для передачі з процесу-воркера)."""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = list(self.values.items())
+        for (key, value) in items:
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}{self._labels(key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values: dict[tuple, float]):
+        """Додає значення, забрані drain() з такої самої метрики в іншому процесі."""
+        with self.lock:
+            for (key, amount) in values.items():
+                self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn=None):
+        super().__init__(name, help_text)
+        self.fn = fn        # якщо задано — значення обчислюється під час збору метрик
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list[str]:
+        if self.fn is not None:
+            self.set(self.fn())
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def merge(self, values: dict[tuple, list]):
+        """Додає значення, забрані drain() з такої самої метрики в іншому процесі."""
+        with self.lock:
+            for (key, (counts, total, count)) in values.items():
+                state = self.values.get(key)
+                if state is None:
+                    state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+                state[0] = [a + b for (a, b) in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        counts, total, count = value
+        lines, cumulative = [], 0
+        for (bound, n) in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f"{self.name}_bucket{self._labels(key, (('le', bound),))} {cumulative}")
+        lines.append(f"{self.name}_bucket{self._labels(key, (('le', '+Inf'),))} {count}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+def observe(histogram: Histogram, **labels):
+    """Декоратор для async-функцій: пише тривалість виклику в histogram."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+registry: list[Metric] = []
+
+POSTS_RECEIVED = Counter("unichannel_posts_received_total", "Channel posts received")
+FORWARDS_ATTEMPTED = Counter("unichannel_forwards_attempted_total", "Forward API calls attempted, per target")
+FORWARDS_SUCCEEDED = Counter("unichannel_forwards_succeeded_total", "Forward API calls succeeded, per target")
+FORWARDS_FAILED = Counter("unichannel_forwards_failed_total", "Forward API calls failed, per target and error")
+HANDLER_LATENCY = Histogram("unichannel_post_handler_seconds", "channel_post_handler latency")
+DB_LATENCY = Histogram("unichannel_db_query_seconds", "Time spent in the SQLite thread per call")
+API_LATENCY = Histogram("unichannel_telegram_api_seconds", "Telegram API call latency, per method")
+CONVERSATION_LATENCY = Histogram("unichannel_conversation_handler_seconds", "Conversation handler latency, per state")
+OUTBOX_BACKLOG = Gauge("unichannel_outbox_backlog", "Outbox rows waiting to be delivered, per status")
+TARGET_CIRCUITS = Gauge("unichannel_target_circuits", "Targets whose circuit breaker is not closed, per state")
+SCHEDULER_QUEUED = Gauge(
+    "unichannel_scheduler_queued", "Forwards queued in memory by the scheduler",
+    fn=lambda: forwarder.queued()
+)
+UPDATES_IN_PROGRESS = Gauge(
+    "unichannel_updates_in_progress", "Updates being handled right now",
+    fn=lambda: update_processor.running
+)
+UPDATES_PENDING = Gauge(
+    "unichannel_updates_pending", "Updates waiting for admission, their chat's turn or a free slot",
+    fn=lambda: update_processor.admitting + update_processor.pending
+)
+UPDATE_WAIT = Histogram("unichannel_update_wait_seconds", "Time from admission to handler start")
+# Метрики, які при FORWARD_WORKERS > 0 рахують процеси-воркери і пересилають у головний процес
+FORWARD_METRICS = (FORWARDS_ATTEMPTED, FORWARDS_SUCCEEDED, FORWARDS_FAILED, API_LATENCY)
+
+
+class SamplingProfiler:
+    """
+    Простий семплюючий профайлер: фоновий потік кожні interval секунд знімає стек
+    головного потоку (event loop) і рахує «folded stacks» (формат для flamegraph.pl / speedscope).
+    Вмикається і вимикається на льоту через /debug/profile/start і /debug/profile/stop.
+    """
+
+    def __init__(self):
+        self.thread: threading.Thread|None = None
+        self.stop_event = threading.Event()
+        self.samples: dict[str, int] = {}
+        self.target_thread_id = threading.main_thread().ident
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, interval: float = 0.005):
+        if self.running:
+            return
+        self.samples = {}
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(interval,), name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> str:
+        if not self.running:
+            return ""
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        return "\n".join(f"{stack} {n}" for (stack, n) in sorted(self.samples.items(), key=lambda i: -i[1]))
+
+    def _run(self, interval: float):
+        while not self.stop_event.wait(interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+
+profiler = SamplingProfiler()
+
+
+async def metrics_http_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Мінімальний HTTP/1.0: GET /metrics, /debug/profile/start[?interval=...], /debug/profile/stop."""
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line[1] if len(request_line) > 1 else "/"
+        route, _, query = path.partition("?")
+        params = dict(p.split("=", 1) for p in query.split("&") if "=" in p)
+
+        status, ctype = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        if route == "/metrics":
+            for state in ("pending", "inflight", "dead"):
+                OUTBOX_BACKLOG.set(0, status=state)
+            for (state, count) in await db.fetchall("SELECT status, COUNT(*) FROM outbox GROUP BY status"):
+                OUTBOX_BACKLOG.set(count, status=state)
+            for (state, count) in target_health.states().items():
+                TARGET_CIRCUITS.set(count, state=state)
+            body = "\n".join(line for metric in registry for line in metric.render()) + "\n"
+        elif route == "/debug/profile/start":
+            profiler.start(float(params.get("interval", "0.005")))
+            body = "profiler started\n"
+        elif route == "/debug/profile/stop":
+            body = profiler.stop() + "\n"
+        else:
+            status, body = "404 Not Found", "not found\n"
+
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+    except Exception:
+        logger.exception("Помилка HTTP-ендпоінта метрик")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server() -> asyncio.Server|None:
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(metrics_http_handler, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        # Метрики — не привід не запуститись (напр. порт зайнятий іншим екземпляром)
+        logger.error("Метрики вимкнено: не вдалося відкрити %s:%d: %s", METRICS_HOST, METRICS_PORT, e)
+        return None
+    logger.info("Метрики: http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    return server
 
 
 # ------------------------------------------------------------------------------------
 #                         РОБОТА З БАЗОЮ ДАНИХ
 # ------------------------------------------------------------------------------------
 
-def init_db():
+class Database:
+    """
+    Шар зберігання: одне довготривале з'єднання SQLite (WAL) у виділеному потоці.
+    Усі запити виконуються в цьому потоці, а async-код лише чекає на результат,
+    тож event loop ніколи не блокується на дисковому I/O.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",      # у WAL цього достатньо для збереження даних після коміту
+        "PRAGMA foreign_keys=ON",         # щоб ON DELETE CASCADE справді працював
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",       # ~16 МБ кешу сторінок
+        "PRAGMA mmap_size=67108864",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: sqlite3.Connection|None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # cached_statements: sqlite3 тримає підготовлені запити між викликами
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _call(self, fn, args):
+        """Виконується у потоці БД: fn(conn, *args) в одній транзакції."""
+        if self._conn is None:
+            self._conn = self._connect()
+        started = time.perf_counter()
+        try:
+            result = fn(self._conn, *args)
+            self._conn.commit()
+            return result
+        except BaseException:
+            self._conn.rollback()
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started)
+
+    async def run(self, fn, *args):
+        """Виконує fn(conn, *args) у потоці БД і повертає результат."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+    def run_sync(self, fn, *args):
+        """Те саме, що run(), але для коду поза event loop (старт/зупинка)."""
+        return self._executor.submit(self._call, fn, args).result()
+
+    async def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        return await self.run(lambda conn: conn.execute(sql, params))
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(_close).result()
+        self._executor.shutdown()
+
+
+db = Database(DB_PATH)
+
+
+def init_db(conn: sqlite3.Connection):
     """Створює таблиці для груп (з user_id) та каналів у групах."""
-    conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
 
     c.execute('''
@@ -63,106 +947,452 @@ def init_db():
             FOREIGN KEY(group_id) REFERENCES groups(id) ON DELETE CASCADE
         )
     ''')
-    conn.commit()
-    conn.close()
+
+    # Індекси під keyset-пагінацію (WHERE user_id=? AND id > ? / WHERE group_id=? AND id > ?)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_groups_user ON groups(user_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_group_channels_group ON group_channels(group_id, id)")
+
+    # Канали зберігаються як числові chat_id (текст у channel / target_channel — лише для показу)
+    add_column(conn, "group_channels", "chat_id", "INTEGER")
+    add_column(conn, "groups", "target_chat_id", "INTEGER")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_group_channels_chat_id ON group_channels(chat_id, group_id)")
+    # Старі рядки з числовим id не потребують запиту до Telegram
+    c.execute("""
+        UPDATE OR IGNORE group_channels SET chat_id = CAST(channel AS INTEGER)
+         WHERE chat_id IS NULL AND channel GLOB '[0-9-]*' AND channel NOT GLOB '*[^0-9-]*'
+    """)
+    c.execute("""
+        UPDATE groups SET target_chat_id = CAST(target_channel AS INTEGER)
+         WHERE target_chat_id IS NULL AND target_channel GLOB '[0-9-]*' AND target_channel NOT GLOB '*[^0-9-]*'
+    """)
+
+    # Черга вихідних пересилань (outbox): переживає рестарти, розбирається фоновим воркером
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_chat INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            target TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+    # Для альбомів: усі message_id через кому (NULL для одиночного поста)
+    add_column(conn, "outbox", "message_ids", "TEXT")
+
+    # Правила фільтрації постів групи: kind = keyword|regex|media, mode = include|exclude
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS group_filters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            pattern TEXT NOT NULL,
+            UNIQUE(group_id, kind, mode, pattern),
+            FOREIGN KEY(group_id) REFERENCES groups(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Придушення дублікатів: прапорець групи і відбитки вже надісланих постів (64-бітні хеші)
+    add_column(conn, "groups", "dedup", "INTEGER NOT NULL DEFAULT 0")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS dedup_fingerprints (
+            target TEXT NOT NULL,
+            kind INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (target, kind, value)
+        ) WITHOUT ROWID
+    ''')
+
+    # Дайджест: інтервал (с, 0 — вимкнено) і формат групи; буфер постів, що чекають на відправку
+    add_column(conn, "groups", "digest_interval", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "groups", "digest_style", "TEXT NOT NULL DEFAULT 'forward'")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS digest_buffer (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target TEXT NOT NULL,
+            source_chat INTEGER NOT NULL,
+            source_username TEXT,
+            message_id INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_digest_buffer_target ON digest_buffer(target, id)")
+    # Текст повідомлення для outbox-рядків дайджесту з посиланнями (NULL — звичайне пересилання)
+    add_column(conn, "outbox", "text", "TEXT")
+
+    # Ціль, яку circuit breaker визнав остаточно недоступною (бота видалили, канал зник тощо):
+    # текст помилки і час; такі групи не маршрутизуються, доки власник не задасть target знову
+    add_column(conn, "groups", "target_error", "TEXT")
+    add_column(conn, "groups", "target_failed_at", "REAL")
+
+    # Кеш метаданих чатів: назва, username і права бота (ChatCache)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_cache (
+            chat_id INTEGER PRIMARY KEY,
+            username TEXT,
+            title TEXT,
+            type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            can_post INTEGER NOT NULL,
+            refreshed_at REAL NOT NULL
+        )
+    ''')
+
+    # Стан розмов між рестартами (SQLitePersistence): user_data і стани ConversationHandler
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS persist_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS persist_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    ''')
+
+    # Знімок індексу маршрутизації. generation зростає тригерами на кожну зміну groups/group_channels
+    # (зокрема з імпорту та міграцій), тож застарілий знімок видно без порівняння вмісту.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS routing_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO routing_meta (id, generation) VALUES (1, 0)")
+    for table in ("groups", "group_channels"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS routing_gen_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN UPDATE routing_meta SET generation = generation + 1; END
+            ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS routing_snapshot (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+def add_column(conn: sqlite3.Connection, table: str, column: str, decl: str):
+    """Міграція: додає колонку до існуючої таблиці, якщо її ще немає."""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
 
 # --- Робота з GROUPS ---
-def add_group_db(user_id: int, name: str) -> bool:
+async def add_group_db(user_id: int, name: str) -> bool:
     """Створює нову групу для користувача user_id з назвою name."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO groups (user_id, name) VALUES (?, ?)", (user_id, name))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
+    def op(conn):
+        try:
+            return conn.execute("INSERT INTO groups (user_id, name) VALUES (?, ?)", (user_id, name)).lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+    group_id = await db.run(op)
+    if group_id is None:
         return False
-    finally:
-        conn.close()
+    routing.add_group(group_id, name)
+    return True
 
-def remove_group_db(user_id: int, name: str) -> bool:
+async def remove_group_db(user_id: int, name: str) -> bool:
     """Видаляє групу (і пов'язані канали) у даного user_id."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM groups WHERE user_id = ? AND name = ?", (user_id, name))
-    conn.commit()
-    deleted = (c.rowcount > 0)
-    conn.close()
-    return deleted
-
-def list_groups_db(user_id: int) -> list[tuple[str, str|None]]:
-    """Повертає список (name, target_channel) усіх груп користувача user_id."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name, target_channel FROM groups WHERE user_id=? ORDER BY id", (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    def op(conn):
+        row = conn.execute("SELECT id FROM groups WHERE user_id = ? AND name = ?", (user_id, name)).fetchone()
+        if not row:
+            return None
+        conn.execute("DELETE FROM groups WHERE id = ?", (row[0],))
+        return row[0]
+
+    group_id = await db.run(op)
+    if group_id is None:
+        return False
+    routing.remove_group(group_id)
+    content_filters.remove_group(group_id)
+    duplicates.enable(group_id, False)
+    digests.configure(group_id, 0, "forward")
+    return True
 
-def get_group_id_by_name(user_id: int, name: str) -> int|None:
+def keyset_page(conn: sqlite3.Connection, sql: str, params: tuple, cursor: int, backward: bool, limit: int):
+    """
+    Keyset-пагінація: sql містить {op}/{order} для умови «id > курсор» (вперед) або «id < курсор» (назад).
+    Повертає (рядки, є_попередня, є_наступна); читаємо limit+1 рядків, щоб знати, чи є ще.
+    """
+    rows = conn.execute(
+        sql.format(op="<" if backward else ">", order="DESC" if backward else "ASC"),
+        (*params, cursor, limit + 1)
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, more, True
+    return rows, cursor > 0, more
+
+async def groups_page_db(user_id: int, cursor: int = 0, backward: bool = False):
+    """Сторінка груп користувача: ([(id, name, target_channel)], є_попередня, є_наступна)."""
+    return await db.run(
+        keyset_page,
+        "SELECT id, name, target_channel FROM groups WHERE user_id=? AND id {op} ? ORDER BY id {order} LIMIT ?",
+        (user_id,), cursor, backward, GROUPS_PAGE_SIZE
+    )
+
+async def get_group_name_db(user_id: int, group_id: int) -> str|None:
+    """Повертає назву групи group_id, якщо вона належить user_id, або None."""
+    row = await db.fetchone("SELECT name FROM groups WHERE id=? AND user_id=?", (group_id, user_id))
+    return row[0] if row else None
+
+async def get_group_id_by_name(user_id: int, name: str) -> int|None:
     """Повертає id групи з назвою name для user_id, або None."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id FROM groups WHERE user_id=? AND name=?", (user_id, name))
-    row = c.fetchone()
-    conn.close()
+    row = await db.fetchone("SELECT id FROM groups WHERE user_id=? AND name=?", (user_id, name))
     return row[0] if row else None
 
 
 # --- Робота з group_channels ---
-def add_channel_to_group_db(group_id: int, channel: str) -> bool:
-    """Додає канал до групи group_id."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO group_channels (group_id, channel) VALUES (?, ?)", (group_id, channel))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
+async def add_channel_to_group_db(group_id: int, chat_id: int, channel: str) -> bool:
+    """Додає канал chat_id до групи group_id; channel — підпис для показу (@username або id)."""
+    def op(conn):
+        try:
+            conn.execute(
+                "INSERT INTO group_channels (group_id, channel, chat_id) VALUES (?, ?, ?)",
+                (group_id, channel, chat_id)
+            )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    added = await db.run(op)
+    if added:
+        routing.add_channel(group_id, chat_id)
+    return added
+
+async def remove_channel_from_group_db(group_id: int, channel: str) -> bool:
+    """
+    Видаляє канал із групи за числовим id або @username: поточним (як його показано у списку
+    з кешу чатів) чи тим, під яким канал додали. Регістр username не має значення.
+    """
+    chat_id = parse_chat_ref(channel)
+    if not isinstance(chat_id, int):
+        info = chat_cache.get(channel)
+        chat_id = info.id if info is not None else None
+
+    def op(conn):
+        rows = conn.execute(
+            "SELECT id, channel, chat_id FROM group_channels WHERE group_id=? AND (channel=? COLLATE NOCASE OR chat_id=?)",
+            (group_id, channel.strip(), chat_id)
+        ).fetchall()
+        conn.executemany("DELETE FROM group_channels WHERE id=?", [(r[0],) for r in rows])
+        return rows
+
+    rows = await db.run(op)
+    for (_, old_channel, old_chat_id) in rows:
+        routing.remove_channel(group_id, old_chat_id if old_chat_id is not None else old_channel)
+    return bool(rows)
+
+async def channels_page_db(user_id: int, group_id: int, cursor: int = 0, backward: bool = False):
+    """Сторінка каналів групи (лише якщо група належить user_id): ([(id, channel, chat_id)], є_попередня, є_наступна)."""
+    return await db.run(
+        keyset_page,
+        """SELECT gc.id, gc.channel, gc.chat_id FROM group_channels gc JOIN groups g ON g.id = gc.group_id
+            WHERE g.user_id=? AND gc.group_id=? AND gc.id {op} ? ORDER BY gc.id {order} LIMIT ?""",
+        (user_id, group_id), cursor, backward, CHANNELS_PAGE_SIZE
+    )
+
+
+# --- Робота з group_filters ---
+async def add_filter_db(group_id: int, kind: str, mode: str, pattern: str) -> int|None:
+    """Додає правило фільтрації; None, якщо таке вже є або досягнуто FILTER_MAX_RULES чи FILTER_MAX_REGEX."""
+    def op(conn):
+        (count,) = conn.execute("SELECT COUNT(*) FROM group_filters WHERE group_id=?", (group_id,)).fetchone()
+        if count >= FILTER_MAX_RULES:
+            return None
+        if kind == "regex":
+            (count,) = conn.execute("SELECT COUNT(*) FROM group_filters WHERE kind='regex'").fetchone()
+            if count >= FILTER_MAX_REGEX:
+                return None
+        try:
+            return conn.execute(
+                "INSERT INTO group_filters (group_id, kind, mode, pattern) VALUES (?, ?, ?, ?)",
+                (group_id, kind, mode, pattern)
+            ).lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+    rule_id = await db.run(op)
+    if rule_id is not None:
+        content_filters.add_rule(rule_id, group_id, kind, mode, pattern)
+    return rule_id
+
+async def remove_filter_db(group_id: int, rule_id: int) -> bool:
+    c = await db.execute("DELETE FROM group_filters WHERE id=? AND group_id=?", (rule_id, group_id))
+    if c.rowcount == 0:
         return False
-    finally:
-        conn.close()
+    content_filters.remove_rule(rule_id)
+    return True
 
-def remove_channel_from_group_db(group_id: int, channel: str) -> bool:
-    """Видаляє канал із групи."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM group_channels WHERE group_id=? AND channel=?", (group_id, channel))
-    conn.commit()
-    deleted = (c.rowcount > 0)
-    conn.close()
-    return deleted
-
-def list_channels_in_group_db(group_id: int) -> list[str]:
-    """Повертає список каналів (str) у групі group_id."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT channel FROM group_channels WHERE group_id=?", (group_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+async def list_filters_db(group_id: int) -> list[tuple[int, str, str, str]]:
+    """Повертає [(id, kind, mode, pattern)] правил групи."""
+    return await db.fetchall(
+        "SELECT id, kind, mode, pattern FROM group_filters WHERE group_id=? ORDER BY id", (group_id,)
+    )
+
+# --- Придушення дублікатів ---
+async def set_group_dedup_db(group_id: int, enabled: bool):
+    await db.execute("UPDATE groups SET dedup=? WHERE id=?", (int(enabled), group_id))
+    duplicates.enable(group_id, enabled)
 
+# --- Дайджест ---
+async def set_group_digest_db(group_id: int, interval: int, style: str):
+    await db.execute(
+        "UPDATE groups SET digest_interval=?, digest_style=? WHERE id=?", (interval, style, group_id)
+    )
+    digests.configure(group_id, interval, style)
 
 # --- Робота з target_channel ---
-def set_group_target_db(group_id: int, target_channel: str):
-    """Задає (або змінює) target_channel для групи group_id."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE groups SET target_channel=? WHERE id=?", (target_channel, group_id))
-    conn.commit()
-    conn.close()
+async def set_group_target_db(group_id: int, target_chat_id: int, target_channel: str):
+    """Задає (або змінює) target для групи group_id; target_channel — підпис для показу."""
+    await db.execute(
+        "UPDATE groups SET target_channel=?, target_chat_id=?, target_error=NULL, target_failed_at=NULL WHERE id=?",
+        (target_channel, target_chat_id, group_id)
+    )
+    routing.set_target(group_id, target_key(target_channel, target_chat_id))
+    routing.set_failed([group_id], False)
+    target_health.reset(target_key(target_channel, target_chat_id))
 
-def get_group_target_db(group_id: int) -> str|None:
+async def get_group_target_db(group_id: int) -> str|None:
     """Повертає target_channel для групи group_id, або None."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT target_channel FROM groups WHERE id=?", (group_id,))
-    row = c.fetchone()
-    conn.close()
+    row = await db.fetchone("SELECT target_channel FROM groups WHERE id=?", (group_id,))
     return row[0] if row else None
 
 
+# ------------------------------------------------------------------------------------
+#                         ЗБЕРЕЖЕННЯ СТАНУ РОЗМОВ (persistence)
+# ------------------------------------------------------------------------------------
+
+# Як часто Application збирає змінені user_data/стани розмов і віддає їх сюди, с
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "15"))
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    user_data і стани ConversationHandler у channels.db, щоб рестарт не викидав адмінів з меню.
+    Application викликає update_* раз на update_interval лише для змінених записів; тут вони
+    накопичуються і пишуться однією транзакцією на цикл, а не по запиту на кожен апдейт.
+    Значення зберігаються як JSON: у user_data лише id/назви груп і прапорці.
+    """
+
+    def __init__(self, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.user_data: dict[int, str|None] = {}                    # user_id -> JSON (None — видалити)
+        self.conversations: dict[tuple[str, str], str|None] = {}    # (name, key) -> JSON стану
+        self._flush_task: asyncio.Task|None = None
+
+    async def get_user_data(self) -> dict[int, dict]:
+        rows = await db.fetchall("SELECT user_id, data FROM persist_user_data")
+        return {user_id: json.loads(data) for (user_id, data) in rows}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await db.fetchall("SELECT key, state FROM persist_conversations WHERE name=?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for (key, state) in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object|None):
+        self.conversations[(name, json.dumps(key))] = None if new_state is None else json.dumps(new_state)
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict):
+        try:
+            self.user_data[user_id] = json.dumps(data, ensure_ascii=False) if data else None
+        except (TypeError, ValueError) as e:
+            logger.warning("user_data %s не серіалізується в JSON, не зберігаємо: %s", user_id, e)
+            return
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int):
+        self.user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    def _schedule_flush(self):
+        # Application віддає зміни пачкою через asyncio.gather; задача стартує після решти її
+        # корутин, тож уся пачка потрапляє в одну транзакцію
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # Зміни, що надійшли під час запису, забираємо тим самим циклом
+        while self.user_data or self.conversations:
+            users, self.user_data = self.user_data, {}
+            conversations, self.conversations = self.conversations, {}
+            await db.run(self._write, users, conversations)
+            logger.debug("Persistence: збережено %d user_data, %d станів розмов.", len(users), len(conversations))
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, users: dict, conversations: dict):
+        conn.executemany(
+            "INSERT OR REPLACE INTO persist_user_data (user_id, data) VALUES (?, ?)",
+            [(user_id, data) for (user_id, data) in users.items() if data is not None]
+        )
+        conn.executemany(
+            "DELETE FROM persist_user_data WHERE user_id=?",
+            [(user_id,) for (user_id, data) in users.items() if data is None]
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO persist_conversations (name, key, state) VALUES (?, ?, ?)",
+            [(*key, state) for (key, state) in conversations.items() if state is not None]
+        )
+        conn.executemany(
+            "DELETE FROM persist_conversations WHERE name=? AND key=?",
+            [key for (key, state) in conversations.items() if state is None]
+        )
+
+
+persistence = SQLitePersistence(PERSIST_INTERVAL)
+
+
 # ------------------------------------------------------------------------------------
 #                         КЛАВІАТУРИ
 # ------------------------------------------------------------------------------------
@@ -178,22 +1408,129 @@ def main_menu_keyboard():
         resize_keyboard=True
     )
 
+# Розмір сторінки для inline-списків (ліміти Telegram: ~100 кнопок, 4096 символів)
+GROUPS_PAGE_SIZE = 10
+CHANNELS_PAGE_SIZE = 50         # верхня межа: сторінку каналів ще й обрізаємо за довжиною тексту
+CHANNEL_TITLE_MAX = 64          # довші назви каналів у списку скорочуються
+
+def pager_buttons(prefix: str, rows: list, has_prev: bool, has_next: bool) -> list[InlineKeyboardButton]:
+    """Кнопки «назад/вперед»: callback_data = '<prefix>|<|<id першого>' або '<prefix>|>|<id останнього>'."""
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}|<|{rows[0][0]}"))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}|>|{rows[-1][0]}"))
+    return buttons
+
 def group_menu_keyboard():
     """Меню для поточної групи."""
     return ReplyKeyboardMarkup(
         [
             [KeyboardButton("➕ Add Channel"), KeyboardButton("➖ Remove Channel")],
             [KeyboardButton("📋 List Channels"), KeyboardButton("🎯 Set Target")],
-            [KeyboardButton("🎯 Get Target"), KeyboardButton("⬅️ Back to Main Menu")],
+            [KeyboardButton("🎯 Get Target"), KeyboardButton("🔎 Filters")],
+            [KeyboardButton("🧹 Dedup"), KeyboardButton("📰 Digest")],
+            [KeyboardButton("⬅️ Back to Main Menu")],
         ],
         resize_keyboard=True
     )
 
+def filters_keyboard():
+    """Меню правил фільтрації поточної групи."""
+    return ReplyKeyboardMarkup(
+        [[KeyboardButton("📋 List Filters"), KeyboardButton("⬅️ Back to Group Menu")]],
+        resize_keyboard=True
+    )
+
 
 # ------------------------------------------------------------------------------------
 #                         ЛОГІКА РОЗМОВИ (ConversationHandler)
 # ------------------------------------------------------------------------------------
 
+# --- Сторінки списків (keyset-пагінація, гортання через edit_message_text) ---
+async def select_group_view(user_id: int, cursor: int = 0, backward: bool = False):
+    """Inline-клавіатура вибору групи; callback_data містить лише компактний id групи."""
+    rows, has_prev, has_next = await groups_page_db(user_id, cursor, backward)
+    if not rows:
+        return "У вас немає груп для вибору!", None
+    keyboard = [[InlineKeyboardButton(gname, callback_data=f"sg|{g_id}")] for (g_id, gname, _) in rows]
+    nav = pager_buttons("gp", rows, has_prev, has_next)
+    if nav:
+        keyboard.append(nav)
+    return "Оберіть групу:", InlineKeyboardMarkup(keyboard)
+
+async def list_groups_view(user_id: int, cursor: int = 0, backward: bool = False):
+    rows, has_prev, has_next = await groups_page_db(user_id, cursor, backward)
+    if not rows:
+        return "У вас немає груп.", None
+    lines = [
+        f"- **{gname}** (target: {tgt if tgt else 'не задано'}{' ⚠️ недоступний' if g_id in routing.failed else ''})"
+        for (g_id, gname, tgt) in rows
+    ]
+    nav = pager_buttons("lg", rows, has_prev, has_next)
+    return "Ваші групи:\n" + "\n".join(lines), InlineKeyboardMarkup([nav]) if nav else None
+
+def channel_line(channel: str, chat_id: int|None) -> str:
+    """Рядок списку каналів з кешу чатів (актуальні username і назва), без запитів до Telegram."""
+    info = chat_cache.get(chat_id) if chat_id is not None else None
+    if info is None:
+        return channel
+    title = info.title
+    if title and len(title) > CHANNEL_TITLE_MAX:
+        title = title[:CHANNEL_TITLE_MAX - 1] + "…"
+    line = f"{chat_label(info)} — {title}" if title else chat_label(info)
+    problem = info.read_problem()
+    return f"{line} ⚠️ {problem}" if problem else line
+
+async def list_channels_view(user_id: int, group_id: int, cursor: int = 0, backward: bool = False):
+    group_name = await get_group_name_db(user_id, group_id)
+    if group_name is None:
+        return "Групу не знайдено.", None
+    rows, has_prev, has_next = await channels_page_db(user_id, group_id, cursor, backward)
+    if not rows:
+        return f"У групі '{group_name}' немає каналів.", None
+    header = f"Канали у групі '{group_name}':"
+    lines = [channel_line(channel, chat_id) for (_, channel, chat_id) in rows]
+
+    # З кешем чатів рядки бувають довгими, тож лишаємо стільки, скільки влазить у повідомлення,
+    # рахуючи від курсора. Решта потрапить на сусідню сторінку: курсор береться з крайнього показаного рядка
+    size, keep = len(header), 0
+    for line in (reversed(lines) if backward else lines):
+        if keep and size + len(line) + 1 > MESSAGE_MAX_LENGTH:
+            break
+        size += len(line) + 1
+        keep += 1
+    if keep < len(rows):
+        if backward:
+            rows, lines, has_prev = rows[-keep:], lines[-keep:], True
+        else:
+            rows, lines, has_next = rows[:keep], lines[:keep], True
+
+    nav = pager_buttons(f"cp|{group_id}", rows, has_prev, has_next)
+    return header + "\n" + "\n".join(lines), InlineKeyboardMarkup([nav]) if nav else None
+
+
+# --- CALLBACKQUERY для гортання сторінок: gp|<dir>|<id>, lg|<dir>|<id>, cp|<group_id>|<dir>|<id> ---
+@observe(CONVERSATION_LATENCY, state="PAGE")
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+    parts = query.data.split("|")
+    direction, cursor = parts[-2], int(parts[-1])
+    backward = (direction == "<")
+
+    parse_mode = None
+    if parts[0] == "gp":
+        text, markup = await select_group_view(user_id, cursor, backward)
+    elif parts[0] == "lg":
+        text, markup = await list_groups_view(user_id, cursor, backward)
+        parse_mode = "Markdown"
+    else:
+        text, markup = await list_channels_view(user_id, int(parts[1]), cursor, backward)
+    await query.edit_message_text(text, reply_markup=markup, parse_mode=parse_mode)
+
+
 # --- /start ---
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Старт розмови з користувачем."""
@@ -204,6 +1541,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MAIN_MENU
 
 # 1) MAIN_MENU: обробляє текст, що приходить із кнопок «Add Group», «Remove Group» тощо.
+@observe(CONVERSATION_LATENCY, state="MAIN_MENU")
 async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = update.effective_user.id
@@ -217,31 +1555,15 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return REMOVING_GROUP
 
     elif text == "📋 List Groups":
-        groups = list_groups_db(user_id)
-        if groups:
-            lines = []
-            for (gname, tgt) in groups:
-                lines.append(f"- **{gname}** (target: {tgt if tgt else 'не задано'})")
-            msg = "Ваші групи:\n" + "\n".join(lines)
-        else:
-            msg = "У вас немає груп."
-        await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=main_menu_keyboard())
+        # Перша сторінка; далі гортаємо inline-кнопками
+        msg, markup = await list_groups_view(user_id)
+        await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=markup or main_menu_keyboard())
         return MAIN_MENU
 
     elif text == "🔽 Select Group":
-        # Показуємо inline-клавіатуру з переліком груп
-        groups = list_groups_db(user_id)
-        if not groups:
-            await update.message.reply_text("У вас немає груп для вибору!", reply_markup=main_menu_keyboard())
-            return MAIN_MENU
-
-        keyboard = []
-        for (gname, _) in groups:
-            # callback_data зберігатиме ім'я групи
-            keyboard.append([InlineKeyboardButton(gname, callback_data=f"selectgroup|{gname}")])
-        markup = InlineKeyboardMarkup(keyboard)
-
-        await update.message.reply_text("Оберіть групу:", reply_markup=markup)
+        # Показуємо inline-клавіатуру з першою сторінкою груп
+        msg, markup = await select_group_view(user_id)
+        await update.message.reply_text(msg, reply_markup=markup or main_menu_keyboard())
         # Залишаємося у стані MAIN_MENU, але тепер чекаємо CallbackQuery
         return MAIN_MENU
 
@@ -257,11 +1579,12 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MAIN_MENU
 
 # 2) Додавання групи
+@observe(CONVERSATION_LATENCY, state="ADDING_GROUP")
 async def adding_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     group_name = update.message.text.strip()
 
-    if add_group_db(user_id, group_name):
+    if await add_group_db(user_id, group_name):
         await update.message.reply_text(
             f"✅ Групу '{group_name}' створено!",
             reply_markup=main_menu_keyboard()
@@ -274,11 +1597,12 @@ async def adding_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MAIN_MENU
 
 # 3) Видалення групи
+@observe(CONVERSATION_LATENCY, state="REMOVING_GROUP")
 async def removing_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     group_name = update.message.text.strip()
 
-    if remove_group_db(user_id, group_name):
+    if await remove_group_db(user_id, group_name):
         await update.message.reply_text(
             f"🗑 Групу '{group_name}' видалено.",
             reply_markup=main_menu_keyboard()
@@ -292,23 +1616,30 @@ async def removing_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- CALLBACKQUERY для вибору групи (натисканні на InlineKeyboard) ---
+@observe(CONVERSATION_LATENCY, state="MAIN_MENU")
 async def select_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обробка callback_data='selectgroup|...' при натисканні на Inline-кнопку."""
+    """Обробка callback_data='sg|<group_id>' при натисканні на Inline-кнопку."""
     query = update.callback_query
     await query.answer()  # Відповідаємо, щоб «зникла» анімація завантаження
 
-    data = query.data  # Наприклад, "selectgroup|MyGroupName"
-    prefix, gname = data.split("|", 1)
+    data = query.data  # Наприклад, "sg|42"
+    prefix, value = data.split("|", 1)
+    user_id = update.effective_user.id
 
-    if prefix != "selectgroup":
+    if prefix == "sg":
+        group_id = int(value)
+        gname = await get_group_name_db(user_id, group_id)
+    elif prefix == "selectgroup":
+        # Кнопки зі старих повідомлень, де в callback_data була назва групи
+        gname = value
+        group_id = await get_group_id_by_name(user_id, gname)
+    else:
         return  # Ігноруємо інші callback'и
 
-    user_id = update.effective_user.id
-    group_id = get_group_id_by_name(user_id, gname)
-    if not group_id:
+    if not group_id or gname is None:
         # Можливо, групу видалили міжчасом
         await query.edit_message_text(
-            text=f"Групу '{gname}' не знайдено.",
+            text="Групу не знайдено.",
         )
         return MAIN_MENU
 
@@ -329,6 +1660,7 @@ async def select_group_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 # 4) Меню групи
+@observe(CONVERSATION_LATENCY, state="GROUP_MENU")
 async def group_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     group_id = context.user_data.get("current_group_id")
@@ -351,13 +1683,8 @@ async def group_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return REMOVING_CHANNEL
 
     elif text == "📋 List Channels":
-        channels = list_channels_in_group_db(group_id)
-        if channels:
-            lines = "\n".join(channels)
-            msg = f"Канали у групі '{group_name}':\n{lines}"
-        else:
-            msg = f"У групі '{group_name}' немає каналів."
-        await update.message.reply_text(msg, reply_markup=group_menu_keyboard())
+        msg, markup = await list_channels_view(update.effective_user.id, group_id)
+        await update.message.reply_text(msg, reply_markup=markup or group_menu_keyboard())
         return GROUP_MENU
 
     elif text == "🎯 Set Target":
@@ -365,14 +1692,43 @@ async def group_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return SETTING_TARGET
 
     elif text == "🎯 Get Target":
-        target = get_group_target_db(group_id)
-        if target:
+        target = await get_group_target_db(group_id)
+        if target and group_id in routing.failed:
+            msg = (f"Цільовий канал групи '{group_name}': {target} — ⚠️ недоступний, пересилання призупинено. "
+                   f"Додайте бота з правом публікації і задайте target знову.")
+        elif target:
             msg = f"Цільовий канал групи '{group_name}': {target}"
         else:
             msg = f"У групи '{group_name}' не задано target-каналу."
         await update.message.reply_text(msg, reply_markup=group_menu_keyboard())
         return GROUP_MENU
 
+    elif text == "🔎 Filters":
+        await update.message.reply_text(FILTERS_HELP, reply_markup=filters_keyboard())
+        return EDITING_FILTERS
+
+    elif text == "🧹 Dedup":
+        enabled = group_id not in duplicates.enabled
+        await set_group_dedup_db(group_id, enabled)
+        if enabled:
+            msg = (f"🧹 Для групи '{group_name}' увімкнено придушення дублікатів: той самий пост "
+                   f"(текст, медіа або майже ідентичний текст) з іншого каналу не пересилатиметься в target "
+                   f"протягом {DEDUP_WINDOW / 3600:g} год.")
+        else:
+            msg = f"Придушення дублікатів для групи '{group_name}' вимкнено."
+        await update.message.reply_text(msg, reply_markup=group_menu_keyboard())
+        return GROUP_MENU
+
+    elif text == "📰 Digest":
+        interval, style = digests.settings.get(group_id, (0, "forward"))
+        current = f"кожні {interval // 60} хв ({style})" if interval else "вимкнено"
+        await update.message.reply_text(
+            f"Дайджест групи '{group_name}': {current}.\n"
+            "Введіть інтервал у хвилинах: «30» — пости накопичуються і пересилаються пачкою, "
+            "«30 links» — одним повідомленням з посиланнями. «0» вимикає дайджест."
+        )
+        return SETTING_DIGEST
+
     elif text == "⬅️ Back to Main Menu":
         await update.message.reply_text(
             "Повертаємось у головне меню.",
@@ -389,12 +1745,29 @@ async def group_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 # --- Додавання каналу у групу ---
+@observe(CONVERSATION_LATENCY, state="ADDING_CHANNEL")
 async def adding_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channel = update.message.text.strip()
     group_id = context.user_data["current_group_id"]
     group_name = context.user_data["current_group_name"]
 
-    if add_channel_to_group_db(group_id, channel):
+    try:
+        chat, problem = await resolve_checked(context.bot, channel, ChatInfo.read_problem)
+    except TelegramError as e:
+        await update.message.reply_text(
+            f"⚠️ Не вдалося знайти канал {channel}: {e.message}",
+            reply_markup=group_menu_keyboard()
+        )
+        return GROUP_MENU
+    channel = chat_label(chat)
+    if problem:
+        await update.message.reply_text(
+            f"⚠️ {channel}: {problem}. Додайте бота адміністратором каналу і спробуйте ще раз.",
+            reply_markup=group_menu_keyboard()
+        )
+        return GROUP_MENU
+
+    if await add_channel_to_group_db(group_id, chat.id, channel):
         await update.message.reply_text(
             f"✅ Канал {channel} додано до групи '{group_name}'.",
             reply_markup=group_menu_keyboard()
@@ -407,12 +1780,13 @@ async def adding_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return GROUP_MENU
 
 # --- Видалення каналу з групи ---
+@observe(CONVERSATION_LATENCY, state="REMOVING_CHANNEL")
 async def removing_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channel = update.message.text.strip()
     group_id = context.user_data["current_group_id"]
     group_name = context.user_data["current_group_name"]
 
-    if remove_channel_from_group_db(group_id, channel):
+    if await remove_channel_from_group_db(group_id, channel):
         await update.message.reply_text(
             f"🗑 Канал {channel} видалено з групи '{group_name}'.",
             reply_markup=group_menu_keyboard()
@@ -425,12 +1799,29 @@ async def removing_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return GROUP_MENU
 
 # --- Задання target-каналу ---
+@observe(CONVERSATION_LATENCY, state="SETTING_TARGET")
 async def setting_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channel = update.message.text.strip()
     group_id = context.user_data["current_group_id"]
     group_name = context.user_data["current_group_name"]
 
-    set_group_target_db(group_id, channel)
+    try:
+        chat, problem = await resolve_checked(context.bot, channel, ChatInfo.post_problem)
+    except TelegramError as e:
+        await update.message.reply_text(
+            f"⚠️ Не вдалося знайти канал {channel}: {e.message}",
+            reply_markup=group_menu_keyboard()
+        )
+        return GROUP_MENU
+    channel = chat_label(chat)
+    if problem:
+        await update.message.reply_text(
+            f"⚠️ {channel}: {problem}. Додайте бота з правом публікації і спробуйте ще раз.",
+            reply_markup=group_menu_keyboard()
+        )
+        return GROUP_MENU
+
+    await set_group_target_db(group_id, chat.id, channel)
     await update.message.reply_text(
         f"🎯 Цільовий канал для групи '{group_name}' тепер: {channel}",
         reply_markup=group_menu_keyboard()
@@ -438,6 +1829,109 @@ async def setting_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return GROUP_MENU
 
 
+# --- Налаштування дайджесту ---
+@observe(CONVERSATION_LATENCY, state="SETTING_DIGEST")
+async def setting_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split()
+    group_id = context.user_data["current_group_id"]
+    group_name = context.user_data["current_group_name"]
+
+    style = parts[1].lower() if len(parts) > 1 else "forward"
+    if not parts or not parts[0].isdigit() or len(parts) > 2 or style not in DIGEST_STYLES:
+        await update.message.reply_text(
+            "⚠️ Очікується число хвилин і, за бажанням, «links», наприклад: 30 або 30 links.",
+            reply_markup=group_menu_keyboard()
+        )
+        return GROUP_MENU
+
+    interval = int(parts[0]) * 60
+    await set_group_digest_db(group_id, interval, style)
+    if interval:
+        msg = (f"📰 Дайджест групи '{group_name}': кожні {parts[0]} хв "
+               f"{'одним повідомленням з посиланнями' if style == 'links' else 'пачкою пересилань'}.")
+    else:
+        msg = f"Дайджест групи '{group_name}' вимкнено, пости пересилаються одразу."
+    await update.message.reply_text(msg, reply_markup=group_menu_keyboard())
+    return GROUP_MENU
+
+
+# --- Правила фільтрації групи ---
+FILTERS_HELP = (
+    "Правила фільтрації постів групи. Надішліть рядок виду:\n"
+    "include keyword <слово>\n"
+    "exclude regex <вираз>\n"
+    "include media <тип>\n"
+    "delete <номер правила>\n\n"
+    "Якщо є include-правила, пересилаються лише пости, що відповідають хоча б одному з них; "
+    "exclude-правило завжди відкидає пост. Ключові слова й regex нечутливі до регістру.\n"
+    "Regex — у синтаксисі RE2: без lookahead і зворотних посилань; \\w і \\d лише ASCII, "
+    "для літер будь-якої мови — \\pL.\n"
+    f"Типи media: {', '.join(MEDIA_KINDS)}."
+)
+
+@observe(CONVERSATION_LATENCY, state="EDITING_FILTERS")
+async def editing_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    group_id = context.user_data["current_group_id"]
+    group_name = context.user_data["current_group_name"]
+
+    if text == "⬅️ Back to Group Menu":
+        await update.message.reply_text(
+            f"Повертаємось до групи '{group_name}'.",
+            reply_markup=group_menu_keyboard()
+        )
+        return GROUP_MENU
+
+    if text == "📋 List Filters":
+        rules = await list_filters_db(group_id)
+        if rules:
+            lines = "\n".join(
+                f"{rule_id}. {mode} {kind} {pattern}{'' if rule_id in content_filters.rules else ' ⚠️ вимкнено'}"
+                for (rule_id, kind, mode, pattern) in rules
+            )
+            msg = f"Правила групи '{group_name}':\n{lines}"
+        else:
+            msg = f"У групи '{group_name}' немає правил — пересилаються всі пости."
+        await update.message.reply_text(msg, reply_markup=filters_keyboard())
+        return EDITING_FILTERS
+
+    parts = text.split(maxsplit=2)
+    if len(parts) == 2 and parts[0].lower() == "delete" and parts[1].isdigit():
+        if await remove_filter_db(group_id, int(parts[1])):
+            msg = f"🗑 Правило {parts[1]} видалено."
+        else:
+            msg = f"❌ Правило {parts[1]} не знайдено в групі '{group_name}'."
+        await update.message.reply_text(msg, reply_markup=filters_keyboard())
+        return EDITING_FILTERS
+
+    if len(parts) < 3 or parts[0].lower() not in FILTER_MODES or parts[1].lower() not in FILTER_KINDS:
+        await update.message.reply_text(FILTERS_HELP, reply_markup=filters_keyboard())
+        return EDITING_FILTERS
+
+    mode, kind, pattern = parts[0].lower(), parts[1].lower(), parts[2]
+    error = None
+    if len(pattern) > FILTER_MAX_PATTERN:
+        error = f"задовге правило (максимум {FILTER_MAX_PATTERN} символів)"
+    elif kind == "media":
+        pattern = pattern.lower()
+        if pattern not in MEDIA_KINDS:
+            error = f"невідомий тип media, доступні: {', '.join(MEDIA_KINDS)}"
+    elif kind == "regex":
+        error = validate_regex(pattern)
+    if error:
+        await update.message.reply_text(f"⚠️ Правило не додано: {error}", reply_markup=filters_keyboard())
+        return EDITING_FILTERS
+
+    rule_id = await add_filter_db(group_id, kind, mode, pattern)
+    if rule_id is None:
+        msg = (f"❌ Правило вже існує або досягнуто ліміту ({FILTER_MAX_RULES} правил на групу, "
+               f"{FILTER_MAX_REGEX} regex-правил на весь бот).")
+    else:
+        msg = f"✅ Правило {rule_id} додано: {mode} {kind} {pattern}"
+    await update.message.reply_text(msg, reply_markup=filters_keyboard())
+    return EDITING_FILTERS
+
+
 # --- Завершення розмови ---
 async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /cancel - завершує розмову."""
@@ -445,60 +1939,2039 @@ async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+# ------------------------------------------------------------------------------------
+#               ПЛАНУВАЛЬНИК ВІДПРАВКИ (rate limiting + паралельний fan-out)
+# ------------------------------------------------------------------------------------
+
+# Ліміти Telegram: ~30 повідомлень/с на бота загалом і ~20/хв в одну групу/канал
+FORWARD_GLOBAL_RATE = float(os.getenv("FORWARD_GLOBAL_RATE", "30"))
+FORWARD_TARGET_RATE_PER_MIN = float(os.getenv("FORWARD_TARGET_RATE_PER_MIN", "20"))
+FORWARD_TARGET_BURST = int(os.getenv("FORWARD_TARGET_BURST", "3"))
+# Скільки секунд простою, після якого воркер цілі завершується
+FORWARD_WORKER_IDLE = 60.0
+
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    """RetryAfter.retry_after може бути int або timedelta залежно від версії PTB."""
+    value = e.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+async def wait_with_timeout(aw, timeout: float):
+    """
+    Як asyncio.wait_for, але не «ковтає» cancel(), якщо він збігся з завершенням
+    очікування (bpo-42130 у Python < 3.12) — інакше воркери не зупиняються.
+    """
+    task = asyncio.ensure_future(aw)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        task.cancel()
+        raise asyncio.TimeoutError
+    return task.result()
+
+
+class TokenBucket:
+    """Класичний token bucket: rate токенів/с, не більше capacity у запасі."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ForwardScheduler:
+    """
+    Черга вихідних пересилань. Кожна ціль має власну чергу і воркер, тож різні цілі
+    обслуговуються паралельно, а порядок у межах однієї цілі зберігається.
+    Перед кожним запитом беремо токен з bucket'а цілі та з глобального bucket'а.
+    RetryAfter призупиняє лише ту ціль, для якої його повернув Telegram.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self.global_bucket = TokenBucket(FORWARD_GLOBAL_RATE, FORWARD_GLOBAL_RATE)
+        self.buckets: dict[str, TokenBucket] = {}
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.workers: dict[str, asyncio.Task] = {}
+
+    def start(self, bot):
+        self.bot = bot
+
+    def queued(self) -> int:
+        return sum(q.qsize() for q in self.queues.values())
+
+    def submit(self, target: str, from_chat_id: int, message_ids: list[int], text: str|None = None) -> asyncio.Future:
+        """
+        Ставить пересилання у чергу цілі; future завершиться результатом або помилкою.
+        Кілька message_ids (альбом) пересилаються одним запитом forward_messages.
+        Якщо задано text (дайджест з посиланнями), замість пересилання надсилається повідомлення.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = asyncio.Queue()
+        queue.put_nowait((from_chat_id, message_ids, text, future))
+        if target not in self.workers:
+            self.workers[target] = asyncio.create_task(self._worker(target, queue))
+        return future
+
+    async def _worker(self, target: str, queue: asyncio.Queue):
+        bucket = self.buckets.get(target)
+        if bucket is None:
+            bucket = self.buckets[target] = TokenBucket(FORWARD_TARGET_RATE_PER_MIN / 60, FORWARD_TARGET_BURST)
+        while True:
+            try:
+                from_chat_id, message_ids, text, future = await wait_with_timeout(queue.get(), FORWARD_WORKER_IDLE)
+            except asyncio.TimeoutError:
+                # Між перевіркою і видаленням немає await, тож submit() не загубить задачу
+                if queue.empty():
+                    del self.queues[target]
+                    del self.workers[target]
+                    return
+                continue
+
+            while True:
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                FORWARDS_ATTEMPTED.inc(target=target)
+                if text is not None:
+                    method = "sendMessage"
+                else:
+                    method = "forwardMessage" if len(message_ids) == 1 else "forwardMessages"
+                started = time.perf_counter()
+                try:
+                    if text is not None:
+                        result = await self.bot.send_message(
+                            chat_id=target,
+                            text=text,
+                            link_preview_options=LinkPreviewOptions(is_disabled=True)
+                        )
+                    elif len(message_ids) == 1:
+                        result = await self.bot.forward_message(
+                            chat_id=target,
+                            from_chat_id=from_chat_id,
+                            message_id=message_ids[0]
+                        )
+                    else:
+                        result = await self.bot.forward_messages(
+                            chat_id=target,
+                            from_chat_id=from_chat_id,
+                            message_ids=message_ids
+                        )
+                except RetryAfter as e:
+                    API_LATENCY.observe(time.perf_counter() - started, method=method)
+                    FORWARDS_FAILED.inc(target=target, error="RetryAfter")
+                    delay = retry_after_seconds(e)
+                    logger.warning("[Target: %s] RetryAfter %ss, ціль призупинено.", target, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                except Exception as e:
+                    API_LATENCY.observe(time.perf_counter() - started, method=method)
+                    FORWARDS_FAILED.inc(target=target, error=type(e).__name__)
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    API_LATENCY.observe(time.perf_counter() - started, method=method)
+                    FORWARDS_SUCCEEDED.inc(target=target)
+                    if not future.done():
+                        future.set_result(result)
+                break
+            queue.task_done()
+
+    async def stop(self, timeout: float = 10.0):
+        """Дочікується (не довше timeout) відправки вже поставлених задач і зупиняє воркери."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues.values())), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не всі пересилання встигли відправитись до зупинки.")
+        for task in list(self.workers.values()):
+            task.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers.clear()
+        self.queues.clear()
+
+
+scheduler = ForwardScheduler()
+
+
+# ------------------------------------------------------------------------------------
+#               ШАРДОВАНІ ВОРКЕРИ ПЕРЕСИЛАННЯ (окремі процеси)
+# ------------------------------------------------------------------------------------
+
+# 0 — пересилання у цьому ж процесі; N > 0 — N процесів, ціль закріплена за одним з них.
+# FORWARD_GLOBAL_RATE ділиться між процесами порівну і статично: кожен отримує 1/N ліміту,
+# тож процес з «гарячими» цілями не позичає запас у простоюючих. Для нерівномірного
+# навантаження N варто тримати малим (або піднімати FORWARD_GLOBAL_RATE, якщо Telegram дозволяє)
+FORWARD_WORKERS = int(os.getenv("FORWARD_WORKERS", "0"))
+FORWARD_WORKER_CHECK = 5.0          # як часто перевіряємо, чи живі процеси
+FORWARD_WORKER_POOL = 256           # HTTP-з'єднань у кожному воркері
+
+
+def portable_error(error: BaseException|None) -> BaseException|None:
+    """Помилка, яку можна передати між процесами (інакше — RuntimeError з repr)."""
+    if error is None:
+        return None
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def forward_worker_main(shard: int, jobs, results, workers: int):
+    """Точка входу процесу-воркера (spawn): власний event loop, Bot і ForwardScheduler."""
+    # Ctrl+C отримує вся група процесів; зупинкою воркерів керує головний процес
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Слухача логів зупиняє atexit: spawn-процес виходить через sys.exit, тож він спрацює
+    asyncio.run(forward_worker_loop(shard, jobs, results, workers))
+
+
+async def forward_worker_loop(shard: int, jobs, results, workers: int):
+    loop = asyncio.get_running_loop()
+    stopping = loop.create_future()
+    done: list[tuple[int, BaseException|None]] = []
+    # Глобальний ліміт діє на токен бота, тож ділимо його між воркерами.
+    # Запас — щонайменше один токен: інакше при rate < 1 bucket ніколи не набере цілого токена
+    rate = FORWARD_GLOBAL_RATE / workers
+    scheduler.global_bucket = TokenBucket(rate, max(1.0, rate))
+
+    def flush_done():
+        # Разом з результатами — прирости метрик пересилань: /metrics віддає головний процес
+        results.put((done[:], {metric.name: metric.drain() for metric in FORWARD_METRICS}))
+        done.clear()
+
+    def on_done(job_id: int, future: asyncio.Future):
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        if not done:
+            loop.call_soon(flush_done)      # результати однієї ітерації — одним повідомленням
+        done.append((job_id, portable_error(error)))
+
+    def on_jobs(batch):
+        if batch is None:
+            if not stopping.done():
+                stopping.set_result(None)
+            return
+        for (job_id, target, from_chat_id, message_ids, text) in batch:
+            future = scheduler.submit(target, from_chat_id, message_ids, text)
+            future.add_done_callback(functools.partial(on_done, job_id))
+
+    def read_jobs():
+        # multiprocessing.Queue блокуючий, тож читаємо його в окремому потоці
+        while True:
+            batch = jobs.get()
+            loop.call_soon_threadsafe(on_jobs, batch)
+            if batch is None:
+                return
+
+    request = HTTPXRequest(connection_pool_size=FORWARD_WORKER_POOL)
+    kwargs = {"base_url": BOT_API_BASE_URL} if BOT_API_BASE_URL else {}
+    async with Bot(BOT_TOKEN, request=request, **kwargs) as bot:
+        scheduler.start(bot)
+        # Задачі, що прийшли до ініціалізації бота, чекають у черзі
+        threading.Thread(target=read_jobs, name=f"forward-jobs-{shard}", daemon=True).start()
+        logger.info("Воркер пересилання #%d запущено (pid %d).", shard, os.getpid())
+        await stopping
+        await scheduler.stop()
+    await asyncio.sleep(0)      # даємо відпрацювати останнім done-callback'ам
+    flush_done()
+
+
+class ShardedForwarder:
+    """
+    Той самий інтерфейс, що й у ForwardScheduler (start/submit/stop), але пересилання
+    виконують FORWARD_WORKERS окремих процесів. Ціль закріплена за процесом через
+    crc32(target) % N, тож порядок у межах цілі зберігається, а різні цілі
+    розходяться по ядрах. Задачі й результати ходять пачками через multiprocessing.Queue.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.ctx = multiprocessing.get_context("spawn")
+        self.processes: list = [None] * workers
+        self.job_queues: list = [None] * workers
+        self.results = None
+        self.reader: threading.Thread|None = None
+        self.monitor: asyncio.Task|None = None
+        self.loop: asyncio.AbstractEventLoop|None = None
+        self.futures: dict[int, tuple[int, asyncio.Future]] = {}
+        self.pending: list[list] = [[] for _ in range(workers)]
+        self.flush_scheduled = False
+        self.next_job_id = 0
+
+    def start(self, bot=None):
+        """bot не використовується: кожен воркер створює власний Bot з тим самим токеном."""
+        self.loop = asyncio.get_running_loop()
+        self.results = self.ctx.Queue()
+        for shard in range(self.workers):
+            self._spawn(shard)
+        self.reader = threading.Thread(target=self._read_results, name="forward-results", daemon=True)
+        self.reader.start()
+        self.monitor = asyncio.create_task(self._monitor())
+
+    def _spawn(self, shard: int):
+        self.job_queues[shard] = self.ctx.Queue()
+        process = self.ctx.Process(
+            target=forward_worker_main,
+            args=(shard, self.job_queues[shard], self.results, self.workers),
+            name=f"forward-worker-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def queued(self) -> int:
+        return len(self.futures)
+
+    def shard_of(self, target: str) -> int:
+        return zlib.crc32(target.encode()) % self.workers
+
+    def submit(self, target: str, from_chat_id: int, message_ids: list[int], text: str|None = None) -> asyncio.Future:
+        future = self.loop.create_future()
+        shard = self.shard_of(target)
+        self.next_job_id += 1
+        self.futures[self.next_job_id] = (shard, future)
+        self.pending[shard].append((self.next_job_id, target, from_chat_id, message_ids, text))
+        if not self.flush_scheduled:
+            # Усі submit'и поточної ітерації loop'а йдуть у воркер однією пачкою
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        self.flush_scheduled = False
+        for shard, batch in enumerate(self.pending):
+            if batch:
+                self.job_queues[shard].put(batch)
+                self.pending[shard] = []
+
+    def _read_results(self):
+        while True:
+            batch = self.results.get()
+            if batch is None:
+                return
+            self.loop.call_soon_threadsafe(self._on_results, batch)
+
+    def _on_results(self, batch: tuple):
+        done, metrics = batch
+        for metric in FORWARD_METRICS:
+            metric.merge(metrics.get(metric.name, {}))
+        for (job_id, error) in done:
+            entry = self.futures.pop(job_id, None)
+            if entry is None or entry[1].done():
+                continue
+            if error is None:
+                entry[1].set_result(None)
+            else:
+                entry[1].set_exception(error)
+
+    def _fail_shard(self, shard: int, error: Exception):
+        for job_id in [j for (j, (s, _)) in self.futures.items() if s == shard]:
+            _, future = self.futures.pop(job_id)
+            if not future.done():
+                future.set_exception(error)
+
+    async def _monitor(self):
+        """Якщо процес-воркер упав — його задачі повертаються в outbox, а процес перезапускається."""
+        while True:
+            await asyncio.sleep(FORWARD_WORKER_CHECK)
+            for shard, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                logger.error("Воркер пересилання #%d завершився (код %s), перезапускаємо.", shard, process.exitcode)
+                self._fail_shard(shard, RuntimeError(f"forward worker #{shard} exited"))
+                self._spawn(shard)
+
+    async def stop(self, timeout: float = 10.0):
+        """Просить воркери дослати поставлене (вони чекають до timeout) і зупиняє їх."""
+        if self.loop is None:
+            return
+        if self.monitor:
+            self.monitor.cancel()
+            await asyncio.gather(self.monitor, return_exceptions=True)
+            self.monitor = None
+        self._flush()
+        for queue in self.job_queues:
+            queue.put(None)
+
+        def join():
+            deadline = time.monotonic() + timeout + 5
+            for process in self.processes:
+                process.join(max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    logger.warning("%s не зупинився вчасно, завершуємо примусово.", process.name)
+                    process.terminate()
+                    process.join()
+            self.results.put(None)
+            self.reader.join()
+
+        await asyncio.get_running_loop().run_in_executor(None, join)
+        await asyncio.sleep(0)      # _on_results, запланові читачем, мають відпрацювати
+        if self.futures:
+            logger.warning("Воркери не встигли переслати %d задач, вони лишаються в outbox.", len(self.futures))
+        for (_, future) in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+
+
+forwarder = ShardedForwarder(FORWARD_WORKERS) if FORWARD_WORKERS > 0 else scheduler
+
+
+# ------------------------------------------------------------------------------------
+#               РЕЗОЛВ КАНАЛІВ І КЕШ МЕТАДАНИХ ЧАТІВ
+# ------------------------------------------------------------------------------------
+
+# Обмеження на get_chat/get_chat_member (міграція, імпорт, фонове оновлення кешу)
+RESOLVE_CONCURRENCY = 5
+RESOLVE_RATE = 10.0     # запитів/с
+
+
+def parse_chat_ref(text: str) -> int|str:
+    """'-100123' -> -100123; '@name' (або будь-що інше) лишається рядком."""
+    text = text.strip()
+    if text.lstrip("-").isdigit():
+        return int(text)
+    return text
+
+def chat_label(chat) -> str:
+    """Підпис каналу для показу користувачу."""
+    return f"@{chat.username}" if chat.username else str(chat.id)
+
+async def resolve_chat(bot, channel: str) -> "ChatInfo":
+    """Повертає ChatInfo за @username або числовим id (з кешу або через get_chat)."""
+    return await chat_cache.fetch(bot, channel)
+
+async def resolve_many(bot, refs) -> dict:
+    """
+    Резолвить багато каналів паралельно; кеш обмежує запити до RESOLVE_CONCURRENCY одночасно
+    і RESOLVE_RATE за секунду. Повертає {ref: ChatInfo або TelegramError}.
+    """
+    async def resolve(ref: str):
+        while True:
+            try:
+                return ref, await resolve_chat(bot, ref)
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+            except TelegramError as e:
+                return ref, e
+
+    return dict(await asyncio.gather(*map(resolve, set(refs))))
+
+
+# Скільки вважаємо свіжими дані чату та права бота в ньому; зміни прав між оновленнями
+# приходять апдейтами my_chat_member, тож TTL — лише страховка
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", str(24 * 3600)))
+CHAT_CACHE_CHECK = 60.0
+CHAT_CACHE_REFRESH_BATCH = 50       # фонових оновлень за одну перевірку
+CHAT_CACHE_RECHECK = 10.0           # відмову в правах з кешу, старшу за це, перепитуємо при додаванні
+
+
+def member_can_post(member, chat_type: str) -> bool:
+    """Чи може бот з таким ChatMember публікувати в чаті цього типу."""
+    if member.status == ChatMember.OWNER:
+        return True
+    if member.status == ChatMember.ADMINISTRATOR:
+        return chat_type != Chat.CHANNEL or bool(member.can_post_messages)
+    if member.status == ChatMember.MEMBER:
+        return chat_type != Chat.CHANNEL
+    if member.status == ChatMember.RESTRICTED:
+        return member.is_member and member.can_send_messages
+    return False
+
+
+class ChatInfo:
+    """Закешовані дані чату і права бота в ньому (підходить і для chat_label)."""
+
+    def __init__(self, chat_id: int, username: str|None, title: str|None, chat_type: str,
+                 status: str, can_post: bool, refreshed_at: float):
+        self.id = chat_id
+        self.username = username
+        self.title = title
+        self.type = chat_type
+        self.status = status
+        self.can_post = can_post
+        self.refreshed_at = refreshed_at
+
+    def read_problem(self) -> str|None:
+        """Чому бот не отримуватиме пости з цього чату (None — отримуватиме)."""
+        if self.status in (ChatMember.LEFT, ChatMember.BANNED):
+            return "бота немає в каналі"
+        if self.type == Chat.CHANNEL and self.status not in (ChatMember.ADMINISTRATOR, ChatMember.OWNER):
+            return "бот не є адміністратором каналу, пости не надходитимуть"
+        return None
+
+    def post_problem(self) -> str|None:
+        """Чому бот не зможе публікувати в цей чат (None — зможе)."""
+        if self.status in (ChatMember.LEFT, ChatMember.BANNED):
+            return "бота немає в каналі"
+        if not self.can_post:
+            return "бот не має права публікувати"
+        return None
+
+    def row(self) -> tuple:
+        return (self.id, self.username, self.title, self.type, self.status, int(self.can_post), self.refreshed_at)
+
+
+class ChatCache:
+    """
+    Кеш метаданих чатів (id, назва, username, статус і права бота) у пам'яті та в таблиці chat_cache.
+    Промах кешу — get_chat + get_chat_member з обмеженням частоти; влучання не коштує запитів.
+    Права оновлюються апдейтами my_chat_member, назви — з самих постів, а фоновий цикл
+    поступово перезапитує записи, старші за CHAT_CACHE_TTL, і забуває чати, яких уже немає в групах.
+    """
+
+    def __init__(self):
+        self.by_id: dict[int, ChatInfo] = {}
+        self.by_username: dict[str, ChatInfo] = {}      # username у нижньому регістрі -> ChatInfo
+        self.dirty: set[int] = set()                    # змінені в пам'яті, ще не записані в базу
+        self.semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+        self.bucket = TokenBucket(RESOLVE_RATE, RESOLVE_CONCURRENCY)
+        self.bot = None
+        self.task: asyncio.Task|None = None
+
+    def load(self, conn: sqlite3.Connection):
+        for row in conn.execute(
+            "SELECT chat_id, username, title, type, status, can_post, refreshed_at FROM chat_cache"
+        ):
+            self._put(ChatInfo(*row[:5], bool(row[5]), row[6]))
+        logger.info("Кеш чатів: %d записів.", len(self.by_id))
+
+    def _put(self, info: ChatInfo):
+        old = self.by_id.get(info.id)
+        if old is not None and old.username and old.username != info.username:
+            self.by_username.pop(old.username.lower(), None)
+        self.by_id[info.id] = info
+        if info.username:
+            self.by_username[info.username.lower()] = info
+
+    def get(self, ref: int|str) -> ChatInfo|None:
+        ref = parse_chat_ref(ref) if isinstance(ref, str) else ref
+        if isinstance(ref, int):
+            return self.by_id.get(ref)
+        return self.by_username.get(ref.lstrip("@").lower())
+
+    async def fetch(self, bot, ref: int|str, max_age: float = CHAT_CACHE_TTL) -> ChatInfo:
+        """ChatInfo з кешу, якщо він не старший за max_age, інакше з Telegram (TelegramError пробрасується)."""
+        info = self.get(ref)
+        if info is not None and time.time() - info.refreshed_at < max_age:
+            return info
+        async with self.semaphore:
+            await self.bucket.acquire()
+            chat = await bot.get_chat(parse_chat_ref(ref) if isinstance(ref, str) else ref)
+            await self.bucket.acquire()
+            try:
+                member = await bot.get_chat_member(chat.id, bot.id)
+                status, can_post = member.status, member_can_post(member, chat.type)
+            except (Forbidden, BadRequest):
+                status, can_post = ChatMember.LEFT, False
+        info = ChatInfo(chat.id, chat.username, chat.title, chat.type, status, can_post, time.time())
+        self._put(info)
+        self.dirty.discard(info.id)
+        await db.execute(
+            "INSERT OR REPLACE INTO chat_cache (chat_id, username, title, type, status, can_post, refreshed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)", info.row()
+        )
+        return info
+
+    def observe(self, chat):
+        """Пост з каналу несе актуальні назву й username — оновлюємо кеш без запитів."""
+        info = self.by_id.get(chat.id)
+        if info is not None and (info.username != chat.username or info.title != chat.title):
+            self._put(ChatInfo(chat.id, chat.username, chat.title, info.type, info.status, info.can_post,
+                               info.refreshed_at))
+            self.dirty.add(chat.id)
+
+    def member_updated(self, chat, member):
+        """Апдейт my_chat_member: права бота в чаті змінились."""
+        self._put(ChatInfo(chat.id, chat.username, chat.title, chat.type, member.status,
+                           member_can_post(member, chat.type), time.time()))
+        self.dirty.add(chat.id)
+
+    def start(self, bot):
+        self.bot = bot
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self._save_dirty()
+
+    async def _save_dirty(self):
+        rows = [self.by_id[chat_id].row() for chat_id in self.dirty if chat_id in self.by_id]
+        self.dirty.clear()
+        if rows:
+            await db.run(lambda conn: conn.executemany(
+                "INSERT OR REPLACE INTO chat_cache (chat_id, username, title, type, status, can_post, refreshed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            ))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CHAT_CACHE_CHECK)
+            try:
+                await self._save_dirty()
+                await self._refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Кеш чатів: помилка фонового оновлення")
+
+    async def _refresh(self):
+        # Потрібні лише канали груп і їхні target'и; решту забуваємо, щоб кеш не ріс без меж
+        used = {c for c in routing.by_channel if isinstance(c, int)}
+        used.update(int(t) for (_, t) in routing.groups.values() if t and t.lstrip("-").isdigit())
+        unused = [chat_id for chat_id in self.by_id if chat_id not in used]
+        for chat_id in unused:
+            info = self.by_id.pop(chat_id)
+            if info.username and self.by_username.get(info.username.lower()) is info:
+                del self.by_username[info.username.lower()]
+        if unused:
+            await db.run(lambda conn: conn.executemany(
+                "DELETE FROM chat_cache WHERE chat_id=?", [(chat_id,) for chat_id in unused]
+            ))
+
+        stale_before = time.time() - CHAT_CACHE_TTL
+        stale = sorted((info.refreshed_at, chat_id) for (chat_id, info) in self.by_id.items()
+                       if info.refreshed_at < stale_before)
+        for (_, chat_id) in stale[:CHAT_CACHE_REFRESH_BATCH]:
+            try:
+                await self.fetch(self.bot, chat_id, max_age=0)
+            except (Forbidden, BadRequest, ChatMigrated):
+                # Чат зник або бота вигнали — це теж актуальний стан
+                info = self.by_id[chat_id]
+                self._put(ChatInfo(chat_id, info.username, info.title, info.type, ChatMember.LEFT, False,
+                                   time.time()))
+                self.dirty.add(chat_id)
+            except TelegramError as e:
+                logger.warning("Кеш чатів: не вдалося оновити %s: %s", chat_id, e.message)
+                return
+
+
+chat_cache = ChatCache()
+
+
+async def resolve_checked(bot, channel: str, check) -> tuple[ChatInfo, str|None]:
+    """
+    resolve_chat + перевірка прав бота (check — ChatInfo.read_problem або ChatInfo.post_problem).
+    Негативну відповідь з кешу перепитуємо в Telegram: бота могли щойно додати в канал.
+    """
+    chat = await resolve_chat(bot, channel)
+    if check(chat) is not None:
+        chat = await chat_cache.fetch(bot, chat.id, max_age=CHAT_CACHE_RECHECK)
+    return chat, check(chat)
+
+
+async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Бота додали, вилучили або змінили його права в чаті — оновлюємо кеш без запитів до Telegram."""
+    change = update.my_chat_member
+    chat_cache.member_updated(change.chat, change.new_chat_member)
+    logger.info("Права бота в %s: %s -> %s.", change.chat.id, change.old_chat_member.status, change.new_chat_member.status)
+
+
+async def resolve_legacy_channels(bot):
+    """
+    Міграція: старі рядки group_channels/groups, де канал записано лише як @username,
+    масово резолвимо через get_chat і записуємо chat_id. Індекс оновлюється інкрементально.
+    """
+    refs = [r[0] for r in await db.fetchall("""
+        SELECT channel FROM group_channels WHERE chat_id IS NULL
+        UNION
+        SELECT target_channel FROM groups WHERE target_chat_id IS NULL AND target_channel IS NOT NULL
+    """)]
+    if not refs:
+        return
+
+    resolved = {}
+    for (ref, chat) in (await resolve_many(bot, refs)).items():
+        if isinstance(chat, TelegramError):
+            logger.warning("Міграція: не вдалося резолвити %s: %s", ref, chat.message)
+        else:
+            resolved[ref] = chat.id
+
+    def op(conn):
+        moved, targets = [], []
+        for (ref, chat_id) in resolved.items():
+            rows = conn.execute(
+                "SELECT id, group_id FROM group_channels WHERE channel=? AND chat_id IS NULL", (ref,)
+            ).fetchall()
+            for (row_id, group_id) in rows:
+                try:
+                    conn.execute("UPDATE group_channels SET chat_id=? WHERE id=?", (chat_id, row_id))
+                except sqlite3.IntegrityError:
+                    # Цей канал уже є у групі під числовим id — дубль просто прибираємо
+                    conn.execute("DELETE FROM group_channels WHERE id=?", (row_id,))
+                moved.append((group_id, ref, chat_id))
+            rows = conn.execute(
+                "SELECT id, target_channel FROM groups WHERE target_channel=? AND target_chat_id IS NULL", (ref,)
+            ).fetchall()
+            conn.executemany("UPDATE groups SET target_chat_id=? WHERE id=?", [(chat_id, r[0]) for r in rows])
+            targets += [(r[0], r[1], chat_id) for r in rows]
+        return moved, targets
+
+    # Зупинка бота скасовує міграцію, але вже розпочатий запис дочікуємось і відображаємо в індексі:
+    # інакше знімок індексу, збережений при зупинці, розійшовся б з базою
+    write = asyncio.ensure_future(db.run(op))
+    cancelled = None
+    try:
+        moved, targets = await asyncio.shield(write)
+    except asyncio.CancelledError as e:
+        moved, targets = await write
+        cancelled = e
+    for (group_id, ref, chat_id) in moved:
+        routing.remove_channel(group_id, ref)
+        routing.add_channel(group_id, chat_id)
+    for (group_id, target_channel, chat_id) in targets:
+        routing.set_target(group_id, target_key(target_channel, chat_id))
+    if cancelled is not None:
+        raise cancelled
+    logger.info("Міграція: резолвлено %d з %d каналів.", len(resolved), len(refs))
+
+
+# ------------------------------------------------------------------------------------
+#               ІМПОРТ / ЕКСПОРТ (/import, /export)
+# ------------------------------------------------------------------------------------
+
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+IMPORT_REPORT_LINES = 30        # скільки рядків конфліктів показувати у відповіді
+CSV_COLUMNS = ("group", "channel", "target")
+
+
+def export_groups(conn: sqlite3.Connection, user_id: int, fmt: str):
+    """
+    Виконується у потоці БД: курсор ітерується рядок за рядком і одразу пишеться
+    у тимчасовий файл, тож увесь список груп у пам'ять не потрапляє.
+    """
+    out = tempfile.TemporaryFile(mode="w+b")
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    cursor = conn.execute("""
+        SELECT g.id, g.name, g.target_channel, gc.channel FROM groups g
+          LEFT JOIN group_channels gc ON gc.group_id = g.id
+         WHERE g.user_id=?
+         ORDER BY g.id, gc.id
+    """, (user_id,))
+
+    if fmt == "json":
+        # [{"group": ..., "target": ..., "channels": [...]}, ...] — пишемо по шматках
+        text.write("[")
+        current = None
+        for (g_id, g_name, g_target, channel) in cursor:
+            if g_id != current:
+                if current is not None:
+                    text.write("]},")
+                text.write(f'\n  {{"group": {json.dumps(g_name, ensure_ascii=False)}, '
+                           f'"target": {json.dumps(g_target, ensure_ascii=False)}, "channels": [')
+                first = True
+                current = g_id
+            if channel is not None:
+                text.write(("" if first else ", ") + json.dumps(channel, ensure_ascii=False))
+                first = False
+        text.write("]}\n]\n" if current is not None else "]\n")
+    else:
+        writer = csv.writer(text)
+        writer.writerow(CSV_COLUMNS)
+        for (_, g_name, g_target, channel) in cursor:
+            writer.writerow((g_name, channel or "", g_target or ""))
+
+    text.flush()
+    text.detach()
+    out.seek(0)
+    return out
+
+
+def parse_import(data: bytes, filename: str) -> tuple[list[tuple[int, str, str|None, str|None]], list[str]]:
+    """
+    Розбирає CSV або JSON у рядки (номер, група, канал, target) і список конфліктів
+    для записів неправильної форми. Кидає ValueError, якщо файл не розібрати зовсім.
+    """
+    text = data.decode("utf-8-sig")
+    rows, conflicts = [], []
+    if filename.lower().endswith(".json") or text.lstrip().startswith("["):
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise ValueError("JSON має бути списком груп")
+        for n, item in enumerate(items, start=1):
+            if not isinstance(item, dict):
+                conflicts.append(f"рядок {n}: очікувався об'єкт групи")
+                continue
+            name = str(item.get("group") or "").strip()
+            target = str(item.get("target") or "").strip() or None
+            channels = item.get("channels") or []
+            if not isinstance(channels, list):
+                # Рядок замість списку інакше розібрався б по символах
+                conflicts.append(f"рядок {n}: channels має бути списком")
+                continue
+            channels = [str(c).strip() for c in channels if str(c).strip()]
+            rows += [(n, name, channel, target) for channel in channels] or [(n, name, None, target)]
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or "group" not in reader.fieldnames:
+            raise ValueError(f"CSV має містити заголовок {','.join(CSV_COLUMNS)}")
+        for n, item in enumerate(reader, start=2):
+            rows.append((
+                n,
+                (item.get("group") or "").strip(),
+                (item.get("channel") or "").strip() or None,
+                (item.get("target") or "").strip() or None,
+            ))
+    return rows, conflicts
+
+
+def import_groups(conn: sqlite3.Connection, user_id: int, rows: list, chats: dict):
+    """
+    Виконується у потоці БД однією транзакцією (db.run): створює групи, задає target'и
+    і додає канали через executemany. Повертає зміни для індексу та список конфліктів.
+    """
+    conflicts = []
+    group_ids = dict(conn.execute("SELECT name, id FROM groups WHERE user_id=?", (user_id,)))
+    new_names = list(dict.fromkeys(name for (_, name, _, _) in rows if name and name not in group_ids))
+    conn.executemany("INSERT INTO groups (user_id, name) VALUES (?, ?)", [(user_id, n) for n in new_names])
+    group_ids = dict(conn.execute("SELECT name, id FROM groups WHERE user_id=?", (user_id,)))
+
+    # UNIQUE(group_id, channel) стоїть на підписі, тож дублікати шукаємо і за chat_id, і за підписом:
+    # старий @username-рядок без chat_id або перейменований канал мають той самий підпис, що й новий
+    existing, labels = set(), set()
+    for (group_id, channel, chat_id) in conn.execute("""
+        SELECT gc.group_id, gc.channel, gc.chat_id FROM group_channels gc
+          JOIN groups g ON g.id = gc.group_id
+         WHERE g.user_id=?
+    """, (user_id,)):
+        existing.add((group_id, chat_id))
+        labels.add((group_id, channel))
+    targets, channels = {}, []
+    for (n, name, channel, target) in rows:
+        if not name:
+            conflicts.append(f"рядок {n}: не вказано групу")
+            continue
+        group_id = group_ids[name]
+        if target:
+            chat = chats[target]
+            if isinstance(chat, TelegramError):
+                conflicts.append(f"рядок {n}: target {target} — {chat.message}")
+            elif chat.post_problem():
+                conflicts.append(f"рядок {n}: target {target} — {chat.post_problem()}")
+            elif targets.get(group_id, (None, chat.id))[1] != chat.id:
+                conflicts.append(f"рядок {n}: для групи '{name}' вже вказано інший target")
+            else:
+                targets[group_id] = (chat_label(chat), chat.id)
+        if channel:
+            chat = chats[channel]
+            if isinstance(chat, TelegramError):
+                conflicts.append(f"рядок {n}: канал {channel} — {chat.message}")
+            elif chat.read_problem():
+                conflicts.append(f"рядок {n}: канал {channel} — {chat.read_problem()}")
+            elif (group_id, chat.id) in existing:
+                conflicts.append(f"рядок {n}: канал {channel} вже є у групі '{name}'")
+            elif (group_id, chat_label(chat)) in labels:
+                conflicts.append(f"рядок {n}: у групі '{name}' вже є канал з підписом {chat_label(chat)}")
+            else:
+                existing.add((group_id, chat.id))
+                labels.add((group_id, chat_label(chat)))
+                channels.append((group_id, chat_label(chat), chat.id))
+
+    conn.executemany(
+        "UPDATE groups SET target_channel=?, target_chat_id=?, target_error=NULL, target_failed_at=NULL WHERE id=?",
+        [(label, chat_id, group_id) for (group_id, (label, chat_id)) in targets.items()]
+    )
+    conn.executemany("INSERT INTO group_channels (group_id, channel, chat_id) VALUES (?, ?, ?)", channels)
+    new_groups = [(group_ids[n], n) for n in new_names]
+    return new_groups, targets, channels, conflicts
+
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv|json] — вивантажує групи, канали й target'и користувача файлом."""
+    fmt = "json" if context.args and context.args[0].lower() == "json" else "csv"
+    out = await db.run(export_groups, update.effective_user.id, fmt)
+    try:
+        await update.message.reply_document(document=out, filename=f"unichannel-groups.{fmt}")
+    finally:
+        out.close()
+
+
+async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/import — наступний надісланий документ (CSV або JSON) буде імпортовано."""
+    context.user_data["awaiting_import"] = True
+    await update.message.reply_text(
+        "Надішліть CSV (колонки group,channel,target) або JSON, отриманий з /export."
+    )
+
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Документ після /import (або з підписом /import): імпорт однією транзакцією."""
+    caption = update.message.caption or ""
+    if not (context.user_data.pop("awaiting_import", False) or caption.startswith("/import")):
+        return
+
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("⚠️ Файл завеликий для імпорту.")
+        return
+    data = await (await document.get_file()).download_as_bytearray()
+    try:
+        rows, bad_rows = parse_import(bytes(data), document.file_name or "")
+    except (ValueError, UnicodeDecodeError) as e:
+        await update.message.reply_text(f"⚠️ Не вдалося розібрати файл: {e}")
+        return
+
+    # Кожен унікальний канал/target резолвимо один раз, паралельно, з rate limit'ом
+    refs = {ref for (_, _, channel, target) in rows for ref in (channel, target) if ref}
+    chats = await resolve_many(context.bot, refs)
+    try:
+        new_groups, targets, channels, conflicts = await db.run(
+            import_groups, update.effective_user.id, rows, chats
+        )
+    except sqlite3.Error as e:
+        # Транзакцію відкочено повністю, тож нічого не імпортовано
+        logger.exception("Імпорт користувача %s не вдався", update.effective_user.id)
+        await update.message.reply_text(f"⚠️ Імпорт не вдався, зміни не збережено: {e}")
+        return
+    conflicts = bad_rows + conflicts
+
+    # Індекс оновлюємо один раз — після коміту всієї транзакції
+    for (group_id, name) in new_groups:
+        routing.add_group(group_id, name)
+    for (group_id, (label, chat_id)) in targets.items():
+        routing.set_target(group_id, target_key(label, chat_id))
+        target_health.reset(target_key(label, chat_id))
+    routing.set_failed(list(targets), False)
+    for (group_id, _, chat_id) in channels:
+        routing.add_channel(group_id, chat_id)
+
+    lines = [
+        f"✅ Імпорт завершено: нових груп {len(new_groups)}, каналів {len(channels)}, target'ів {len(targets)}.",
+    ]
+    if conflicts:
+        lines.append(f"⚠️ Конфліктів: {len(conflicts)}")
+        lines += conflicts[:IMPORT_REPORT_LINES]
+        if len(conflicts) > IMPORT_REPORT_LINES:
+            lines.append(f"... і ще {len(conflicts) - IMPORT_REPORT_LINES}")
+    await update.message.reply_text("\n".join(lines))
+
+
+# ------------------------------------------------------------------------------------
+#               ЗДОРОВ'Я ЦІЛЕЙ (circuit breaker для недоступних target'ів)
+# ------------------------------------------------------------------------------------
+
+# Скільки тимчасових помилок поспіль розмикають запобіжник цілі
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", "5"))
+HEALTH_BACKOFF_BASE = 30.0      # секунди до першої пробної відправки; далі 60, 120...
+HEALTH_BACKOFF_MAX = 3600.0
+HEALTH_PROBE_WAIT = 5.0         # на скільки відкладати решту задач цілі, поки йде проба
+
+# Тексти BadRequest, які означають, що проблема в самій цілі (а не в пості-джерелі)
+TARGET_ERRORS = (
+    "chat not found", "bot is not a member", "bot was kicked", "not enough rights", "have no rights",
+    "need administrator rights", "chat_write_forbidden", "chat_admin_required", "channel_private",
+    "peer_id_invalid", "chat_restricted", "group chat was deactivated", "upgraded to a supergroup",
+)
+
+
+def classify_error(error: BaseException) -> str|None:
+    """
+    'permanent' — ціль недоступна, доки власник її не виправить (бота видалено, чат зник);
+    'transient' — мережа, таймаути, збої Telegram: варто повторити пізніше;
+    None — помилка стосується конкретного поста (напр. його видалили з джерела), а не цілі.
+    """
+    if isinstance(error, (Forbidden, ChatMigrated)):
+        return "permanent"
+    if isinstance(error, BadRequest):
+        message = error.message.lower()
+        return "permanent" if any(text in message for text in TARGET_ERRORS) else None
+    return "transient"
+
+
+async def target_unwritable(bot, target: str) -> str|None:
+    """Перевіряє права бота в target свіжим запитом (оновлює й кеш чатів); None — публікувати можна."""
+    try:
+        info = await chat_cache.fetch(bot, target, max_age=0)
+    except (Forbidden, BadRequest, ChatMigrated) as e:
+        return e.message
+    return info.post_problem()
+
+
+class Circuit:
+    """Стан запобіжника однієї цілі."""
+
+    def __init__(self):
+        # closed — працює; open — чекаємо retry_at; probing — йде одна пробна відправка;
+        # checking — перевіряємо права після «остаточної» помилки; failed — ціль вимкнено
+        self.state = "closed"
+        self.failures = 0
+        self.backoff = 0.0
+        self.retry_at = 0.0
+
+
+class TargetHealth:
+    """
+    Circuit breaker для цілей. Outbox перед відправкою питає admit(): для розімкненої цілі
+    задачі відкладаються (без витрати спроб), після backoff'у йде одна пробна відправка
+    (half-open), успіх замикає ланцюг, невдача подвоює backoff.
+    «Остаточні» помилки (Forbidden, chat not found...) перевіряються через get_chat_member:
+    якщо бот справді не може публікувати, групи з цим target'ом позначаються в groups.target_error,
+    випадають з маршрутизації, а їхні власники отримують повідомлення.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self.circuits: dict[str, Circuit] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def start(self, bot):
+        self.bot = bot
+
+    def admit(self, target: str) -> str:
+        """'send' — відправляти; 'defer' — відкласти до defer_until(); 'drop' — ціль вимкнено."""
+        circuit = self.circuits.get(target)
+        if circuit is None or circuit.state == "closed":
+            return "send"
+        if circuit.state == "failed":
+            return "drop"
+        if circuit.state == "open" and time.time() >= circuit.retry_at:
+            circuit.state = "probing"
+            return "send"
+        return "defer"
+
+    def defer_until(self, target: str) -> float:
+        circuit = self.circuits.get(target)
+        if circuit is not None and circuit.state == "open":
+            return circuit.retry_at
+        return time.time() + HEALTH_PROBE_WAIT
+
+    def reset(self, target: str):
+        """Власник задав target заново — починаємо з чистого аркуша."""
+        self.circuits.pop(target, None)
+
+    def record(self, target: str, error: BaseException|None):
+        """Результат відправки в target (викликається outbox'ом для кожної задачі)."""
+        circuit = self.circuits.get(target)
+        if isinstance(error, asyncio.CancelledError):
+            # Зупинка, а не відповідь цілі: пробу доведеться повторити
+            if circuit is not None and circuit.state == "probing":
+                circuit.state = "open"
+            return
+        kind = None if error is None else classify_error(error)
+        if kind is None:
+            if circuit is not None and circuit.state != "failed":
+                if circuit.state != "closed":
+                    logger.info("[Target: %s] Ціль знову доступна, запобіжник замкнено.", target)
+                del self.circuits[target]
+            return
+
+        if circuit is None:
+            circuit = self.circuits[target] = Circuit()
+        if kind == "permanent":
+            if circuit.state not in ("checking", "failed"):
+                circuit.state = "checking"
+                task = asyncio.create_task(self._verify(target, circuit, error))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        elif circuit.state == "probing":
+            self._open(target, circuit, error)
+        elif circuit.state == "closed":
+            circuit.failures += 1
+            if circuit.failures >= HEALTH_FAILURE_THRESHOLD:
+                self._open(target, circuit, error)
+
+    def _open(self, target: str, circuit: Circuit, error: BaseException):
+        circuit.backoff = min(circuit.backoff * 2, HEALTH_BACKOFF_MAX) if circuit.backoff else HEALTH_BACKOFF_BASE
+        circuit.retry_at = time.time() + circuit.backoff * random.uniform(0.8, 1.2)
+        circuit.state = "open"
+        logger.warning("[Target: %s] Запобіжник розімкнено на ~%.0f с: %r", target, circuit.backoff, error)
+
+    async def _verify(self, target: str, circuit: Circuit, error: BaseException):
+        try:
+            reason = await target_unwritable(self.bot, target)
+        except Exception as e:
+            # Перевірити не вдалося (мережа, ліміти) — поводимось як з тимчасовою помилкою
+            if self.circuits.get(target) is circuit:
+                self._open(target, circuit, e)
+            return
+        if self.circuits.get(target) is not circuit:
+            return      # поки перевіряли, ціль уже відповіла успіхом або її задали заново
+        if reason is None:
+            # Права на місці — помилка, найімовірніше, не про ціль; рахуємо як тимчасову
+            circuit.state = "closed"
+            circuit.failures += 1
+            if circuit.failures >= HEALTH_FAILURE_THRESHOLD:
+                self._open(target, circuit, error)
+            return
+        circuit.state = "failed"
+        await self._fail(target, reason)
+
+    async def _fail(self, target: str, reason: str):
+        group_ids = [g_id for g_id in routing.groups_with_target(target) if g_id not in routing.failed]
+        if not group_ids:
+            return
+
+        def op(conn):
+            conn.executemany(
+                "UPDATE groups SET target_error=?, target_failed_at=? WHERE id=?",
+                [(reason, time.time(), g_id) for g_id in group_ids]
+            )
+            return conn.execute(
+                f"SELECT user_id, name FROM groups WHERE id IN ({','.join('?' * len(group_ids))})", group_ids
+            ).fetchall()
+
+        rows = await db.run(op)
+        routing.set_failed(group_ids)
+        logger.error("[Target: %s] Ціль недоступна (%s), вимкнено груп: %d.", target, reason, len(group_ids))
+
+        owners: dict[int, list[str]] = {}
+        for (user_id, g_name) in rows:
+            owners.setdefault(user_id, []).append(g_name)
+        for (user_id, g_names) in owners.items():
+            try:
+                await self.bot.send_message(
+                    chat_id=user_id,
+                    text=(
+                        f"⚠️ Не вдається публікувати в {target}: {reason}.\n"
+                        f"Пересилання для груп {', '.join(g_names)} призупинено. Додайте бота в канал "
+                        f"з правом публікації і задайте target знову (🎯 Set Target)."
+                    )
+                )
+            except TelegramError as e:
+                logger.warning("Не вдалося сповістити користувача %d: %s", user_id, e.message)
+
+    def states(self) -> dict[str, int]:
+        counts = dict.fromkeys(("open", "probing", "checking", "failed"), 0)
+        for circuit in self.circuits.values():
+            if circuit.state in counts:
+                counts[circuit.state] += 1
+        return counts
+
+
+target_health = TargetHealth()
+
+
+# ------------------------------------------------------------------------------------
+#               OUTBOX (надійна черга пересилань у SQLite)
+# ------------------------------------------------------------------------------------
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+# Скільки задач може одночасно бути у forwarder'і (решта чекає в базі)
+OUTBOX_MAX_INFLIGHT = int(os.getenv("OUTBOX_MAX_INFLIGHT", "1000"))
+# ...і скільки з них може належати одній цілі: ціль розбирається зі швидкістю свого rate limit'у,
+# тож без цієї межі одна «гаряча» ціль зайняла б усі слоти і решта цілей стояла б
+OUTBOX_TARGET_INFLIGHT = int(os.getenv("OUTBOX_TARGET_INFLIGHT", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = 2.0       # секунди; далі 4, 8, 16...
+OUTBOX_BACKOFF_MAX = 600.0
+OUTBOX_POLL_INTERVAL = 5.0
+
+
+class Outbox:
+    """
+    Outbox-черга: хендлер лише записує (source_chat, message_id, target) у таблицю outbox,
+    а фоновий воркер пачками забирає готові рядки і віддає їх forwarder'у
+    (scheduler у цьому процесі або шардовані процеси-воркери).
+    Успішні рядки видаляються, невдалі повторюються з експоненційною затримкою,
+    після OUTBOX_MAX_ATTEMPTS спроб рядок отримує статус 'dead'.
+    Доставка — at-least-once: після падіння рядки 'inflight' повертаються у 'pending'.
+    """
+
+    def __init__(self):
+        self.task: asyncio.Task|None = None
+        self.wakeup = asyncio.Event()
+        self.inflight: dict[int, tuple[int, str]] = {}      # outbox.id -> (attempts, target)
+        self.busy: dict[str, int] = {}                      # target -> задач у forwarder'і
+        self.results: list[tuple[int, Exception|None]] = []
+
+    @staticmethod
+    def recover(conn: sqlite3.Connection):
+        """Викликається при старті: незавершені після падіння задачі знову стають 'pending'."""
+        c = conn.execute("UPDATE outbox SET status='pending' WHERE status='inflight'")
+        if c.rowcount:
+            logger.info("Outbox: відновлено %d незавершених пересилань.", c.rowcount)
+
+    async def enqueue(self, jobs: list[tuple[int, list[int], str]]):
+        """Записує пачку задач (source_chat, [message_id, ...], target) однією транзакцією."""
+        if not jobs:
+            return
+        now = time.time()
+        await db.run(lambda conn: conn.executemany(
+            "INSERT INTO outbox (source_chat, message_id, message_ids, target, created_at) VALUES (?, ?, ?, ?, ?)",
+            [
+                (src, mids[0], ",".join(map(str, mids)) if len(mids) > 1 else None, target, now)
+                for (src, mids, target) in jobs
+            ]
+        ))
+        self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        # Дочікуємось уже відданих forwarder'у задач і фіксуємо їх результат
+        await forwarder.stop()
+        await self._apply_results()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._apply_results()
+                room = OUTBOX_MAX_INFLIGHT - len(self.inflight)
+                batch, more = await db.run(
+                    self._claim, min(OUTBOX_BATCH_SIZE, room), dict(self.busy)
+                ) if room > 0 else ([], False)
+                deferred, dropped = [], []
+                for (row_id, src, mids, target, text, attempts) in batch:
+                    verdict = target_health.admit(target)
+                    if verdict == "defer":
+                        deferred.append((target_health.defer_until(target), row_id))
+                        continue
+                    if verdict == "drop":
+                        dropped.append((f"ціль {target} недоступна", row_id))
+                        continue
+                    self.inflight[row_id] = (attempts, target)
+                    self.busy[target] = self.busy.get(target, 0) + 1
+                    future = forwarder.submit(target, src, mids, text)
+                    future.add_done_callback(lambda f, row_id=row_id: self._on_done(row_id, f))
+                if deferred or dropped:
+                    await db.run(self._hold, deferred, dropped)
+                if more:
+                    continue    # у базі, найімовірніше, є ще готові рядки
+
+                self.wakeup.clear()
+                try:
+                    await wait_with_timeout(self.wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Outbox: помилка воркера")
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    @staticmethod
+    def _claim(conn: sqlite3.Connection, limit: int, busy: dict[str, int]) -> tuple[list[tuple], bool]:
+        """
+        Забирає до limit готових рядків, але кожній цілі — не більше OUTBOX_TARGET_INFLIGHT
+        разом з уже відданими forwarder'у (busy: target -> кількість). Цілі без вільних слотів
+        відсікає сам запит, надлишок решти лишається 'pending' до наступного claim'у.
+        Повертає (рядки, чи могли в базі лишитись ще готові).
+        """
+        full = [target for (target, count) in busy.items() if count >= OUTBOX_TARGET_INFLIGHT]
+        fetched = conn.execute("""
+            SELECT id, source_chat, message_id, message_ids, target, text, attempts FROM outbox
+             WHERE status='pending' AND next_attempt_at <= ?
+               AND target NOT IN (SELECT value FROM json_each(?))
+             ORDER BY id LIMIT ?
+        """, (time.time(), json.dumps(full), limit)).fetchall()
+        rows = []
+        for row in fetched:
+            count = busy.get(row[4], 0)
+            if count < OUTBOX_TARGET_INFLIGHT:
+                busy[row[4]] = count + 1
+                rows.append(row)
+        conn.executemany("UPDATE outbox SET status='inflight' WHERE id=?", [(r[0],) for r in rows])
+        return [
+            (row_id, src, [int(m) for m in mids.split(",")] if mids else [mid], target, text, attempts)
+            for (row_id, src, mid, mids, target, text, attempts) in rows
+        ], len(fetched) == limit
+
+    @staticmethod
+    def _hold(conn: sqlite3.Connection, deferred: list[tuple], dropped: list[tuple]):
+        """Задачі розімкнених цілей: відкладаємо без витрати спроб; задачі вимкнених — у 'dead'."""
+        conn.executemany("UPDATE outbox SET status='pending', next_attempt_at=? WHERE id=?", deferred)
+        conn.executemany("UPDATE outbox SET status='dead', last_error=? WHERE id=?", dropped)
+
+    def _on_done(self, row_id: int, future: asyncio.Future):
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        self.results.append((row_id, error))
+        self.wakeup.set()
+
+    async def _apply_results(self):
+        if not self.results:
+            return
+        results, self.results = self.results, []
+        done, retry, dead = [], [], []
+        now = time.time()
+        for (row_id, error) in results:
+            attempts, target = self.inflight.pop(row_id, (0, None))
+            attempts += 1
+            if target is not None:
+                target_health.record(target, error)
+                if self.busy[target] > 1:
+                    self.busy[target] -= 1
+                else:
+                    del self.busy[target]
+            if error is None:
+                done.append((row_id,))
+            elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                dead.append((attempts, repr(error), row_id))
+            else:
+                delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                delay *= random.uniform(0.5, 1.0)
+                retry.append((attempts, now + delay, repr(error), row_id))
+
+        def op(conn):
+            conn.executemany("DELETE FROM outbox WHERE id=?", done)
+            conn.executemany(
+                "UPDATE outbox SET status='pending', attempts=?, next_attempt_at=?, last_error=? WHERE id=?", retry
+            )
+            conn.executemany("UPDATE outbox SET status='dead', attempts=?, last_error=? WHERE id=?", dead)
+
+        await db.run(op)
+        for (attempts, _, error, row_id) in retry:
+            logger.warning("Outbox #%d: спроба %d невдала (%s), повторимо пізніше.", row_id, attempts, error)
+        for (attempts, error, row_id) in dead:
+            logger.error("Outbox #%d: %d невдалих спроб (%s), задачу позначено як dead.", row_id, attempts, error)
+
+
+outbox = Outbox()
+
+
+# ------------------------------------------------------------------------------------
+#               ДАЙДЖЕСТ (накопичення постів для «гарячих» цілей)
+# ------------------------------------------------------------------------------------
+
+DIGEST_STYLES = ("forward", "links")
+# Скільки постів може накопичитись для однієї цілі: досягнувши ліміту, дайджест іде одразу
+DIGEST_MAX_POSTS = int(os.getenv("DIGEST_MAX_POSTS", "500"))
+DIGEST_CHECK_INTERVAL = 10.0
+FORWARD_MESSAGES_MAX = 100      # message_ids в одному forward_messages
+MESSAGE_MAX_LENGTH = 4000       # трохи менше за ліміт Telegram у 4096 символів
+
+
+def post_link(chat_id: int, username: str|None, message_id: int) -> str:
+    if username:
+        return f"https://t.me/{username}/{message_id}"
+    # Приватний канал: t.me/c/<id без -100>/<message_id> (відкривається для учасників)
+    return f"https://t.me/c/{str(chat_id).removeprefix('-100')}/{message_id}"
+
+
+def digest_jobs(rows: list[tuple], target: str, style: str) -> list[tuple]:
+    """
+    Рядки буфера (source_chat, source_username, message_id) -> outbox-рядки
+    (source_chat, message_id, message_ids, target, text).
+    forward: по одному forward_messages на канал-джерело (до 100 постів у запиті);
+    links: повідомлення з посиланнями, розбиті за лімітом довжини.
+    """
+    jobs = []
+    if style == "links":
+        lines = [f"📰 Дайджест: {len(rows)} постів"]
+        lines += [f"• {post_link(src, username, mid)}" for (src, username, mid) in rows]
+        text = ""
+        for line in lines:
+            if len(text) + len(line) + 1 > MESSAGE_MAX_LENGTH:
+                jobs.append((0, 0, None, target, text))
+                text = ""
+            text = f"{text}\n{line}" if text else line
+        jobs.append((0, 0, None, target, text))
+        return jobs
+
+    by_source: dict[int, list[int]] = {}
+    for (src, _, mid) in rows:
+        by_source.setdefault(src, []).append(mid)
+    for (src, mids) in by_source.items():
+        for i in range(0, len(mids), FORWARD_MESSAGES_MAX):
+            chunk = mids[i:i + FORWARD_MESSAGES_MAX]
+            jobs.append((src, chunk[0], ",".join(map(str, chunk)) if len(chunk) > 1 else None, target, None))
+    return jobs
+
+
+class DigestBuffer:
+    """
+    Режим дайджесту: пости для цілей, де хоча б одна група увімкнула дайджест, не йдуть в outbox
+    одразу, а накопичуються в таблиці digest_buffer (переживає рестарти). Раз на інтервал
+    (або по досягненні DIGEST_MAX_POSTS) буфер цілі однією транзакцією перетворюється
+    на кілька outbox-рядків — замість запиту на кожен пост.
+    У пам'яті лише лічильники: кількість і час найстаршого поста для кожної цілі.
+    """
+
+    def __init__(self):
+        self.settings: dict[int, tuple[int, str]] = {}     # group_id -> (інтервал, формат)
+        self.counts: dict[str, int] = {}
+        self.oldest: dict[str, float] = {}
+        self.task: asyncio.Task|None = None
+        self.wakeup = asyncio.Event()
+        self.version = 0
+        self.cached_targets: tuple[tuple[int, int], dict[str, tuple[int, str]]] = ((-1, -1), {})
+
+    def load(self, conn: sqlite3.Connection):
+        self.settings = {
+            g_id: (interval, style) for (g_id, interval, style) in
+            conn.execute("SELECT id, digest_interval, digest_style FROM groups WHERE digest_interval > 0")
+        }
+        for (target, count, oldest) in conn.execute(
+            "SELECT target, COUNT(*), MIN(created_at) FROM digest_buffer GROUP BY target"
+        ):
+            self.counts[target] = count
+            self.oldest[target] = oldest
+        self.version += 1
+        logger.info("Дайджест: %d груп, %d постів у буфері.", len(self.settings), sum(self.counts.values()))
+
+    def configure(self, group_id: int, interval: int, style: str):
+        self.version += 1
+        if interval > 0:
+            self.settings[group_id] = (interval, style)
+        else:
+            self.settings.pop(group_id, None)
+        self.wakeup.set()     # щоб буфер цілі, де дайджест вимкнули, не чекав свого інтервалу
+
+    def targets(self) -> dict[str, tuple[int, str]]:
+        """target -> (інтервал, формат); якщо груп кілька, діє найкоротший інтервал."""
+        version = (routing.version, self.version)
+        if self.cached_targets[0] != version:
+            targets = {}
+            for (g_id, setting) in sorted(self.settings.items(), key=lambda item: -item[1][0]):
+                target = routing.groups.get(g_id, (None, None))[1]
+                if target:
+                    targets[target] = setting
+            self.cached_targets = (version, targets)
+        return self.cached_targets[1]
+
+    async def add(self, jobs: list[tuple[int, list[int], str]], username: str|None):
+        if not jobs:
+            return
+        now = time.time()
+        await db.run(lambda conn: conn.executemany(
+            "INSERT INTO digest_buffer (target, source_chat, source_username, message_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(target, src, username, mid, now) for (src, mids, target) in jobs for mid in mids]
+        ))
+        for (_, mids, target) in jobs:
+            self.counts[target] = self.counts.get(target, 0) + len(mids)
+            self.oldest.setdefault(target, now)
+            if self.counts[target] >= DIGEST_MAX_POSTS:
+                self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Накопичене лишається в базі й піде з наступним дайджестом після рестарту
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.flush_due()
+                self.wakeup.clear()
+                try:
+                    await wait_with_timeout(self.wakeup.wait(), DIGEST_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Дайджест: помилка воркера")
+                await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+
+    async def flush_due(self):
+        now = time.time()
+        targets = self.targets()
+        for target in list(self.counts):
+            # Ціль, де дайджест вимкнули, спорожнюємо одразу (пачкою пересилань)
+            interval, style = targets.get(target, (0, "forward"))
+            if now - self.oldest[target] >= interval or self.counts[target] >= DIGEST_MAX_POSTS:
+                await self.flush(target, style)
+
+    async def flush(self, target: str, style: str):
+        def op(conn):
+            rows = conn.execute(
+                "SELECT id, source_chat, source_username, message_id FROM digest_buffer "
+                "WHERE target=? ORDER BY id LIMIT ?", (target, DIGEST_MAX_POSTS)
+            ).fetchall()
+            if not rows:
+                return 0, None
+            jobs = digest_jobs([row[1:] for row in rows], target, style)
+            conn.executemany(
+                "INSERT INTO outbox (source_chat, message_id, message_ids, target, text, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(*job, time.time()) for job in jobs]
+            )
+            conn.execute("DELETE FROM digest_buffer WHERE target=? AND id <= ?", (target, rows[-1][0]))
+            left = conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM digest_buffer WHERE target=?", (target,)
+            ).fetchone()
+            return len(rows), left
+
+        sent, left = await db.run(op)
+        if left and left[0]:
+            self.counts[target], self.oldest[target] = left
+        else:
+            self.counts.pop(target, None)
+            self.oldest.pop(target, None)
+        if sent:
+            logger.info("Дайджест для %s: %d постів передано в outbox.", target, sent)
+            outbox.wakeup.set()
+
+
+digests = DigestBuffer()
+
+
+# ------------------------------------------------------------------------------------
+#               ДЕДУПЛІКАЦІЯ КОНТЕНТУ (той самий пост з різних каналів)
+# ------------------------------------------------------------------------------------
+
+# Скільки секунд пам'ятаємо надіслані в target пости і скільки відбитків тримаємо в пам'яті
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", str(6 * 3600)))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "200000"))
+DEDUP_MIN_TEXT = 30             # коротші тексти («фото», «🔥») не вважаємо змістом для порівняння
+DEDUP_SIMHASH_DISTANCE = 6      # біт різниці, за яких тексти вважаються майже однаковими
+DEDUP_FLUSH_INTERVAL = 30.0
+
+FP_TEXT, FP_MEDIA, FP_SIMHASH = range(3)
+MASK64 = (1 << 64) - 1
+# SimHash ділимо на DISTANCE+1 смуг: якщо відстань ≤ DISTANCE, хоча б одна смуга збігається повністю,
+# тож кандидатів шукаємо за смугами, а не перебором усіх відбитків
+SIMHASH_BANDS = DEDUP_SIMHASH_DISTANCE + 1
+SIMHASH_BAND_BITS = 64 // SIMHASH_BANDS
+ATTACHMENT_KINDS = ("video", "animation", "document", "audio", "voice", "video_note", "sticker")
+
+
+def hash64(data: str) -> int:
+    """64-бітний хеш зі знаком (так він уміщується в INTEGER SQLite)."""
+    return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+def simhash(words: list[str]) -> int:
+    """SimHash слів тексту: кожен біт — «голосування» бітів хешів слів."""
+    columns = zip(*(format(hash64(w) & MASK64, "064b") for w in words))
+    half = len(words) / 2
+    return int("".join("1" if column.count("1") > half else "0" for column in columns), 2)
+
+
+def simhash_bands(target: str, value: int):
+    for band in range(SIMHASH_BANDS):
+        yield (target, band, (value >> (SIMHASH_BAND_BITS * band)) & ((1 << SIMHASH_BAND_BITS) - 1))
+
+
+def post_media_ids(message) -> list[str]:
+    """file_unique_id вкладення (для фото — найбільшого розміру)."""
+    if message.photo:
+        return [message.photo[-1].file_unique_id]
+    for kind in ATTACHMENT_KINDS:
+        attachment = getattr(message, kind, None)
+        if attachment:
+            return [attachment.file_unique_id]
+    return []
+
+
+def post_fingerprints(text: str, media_ids: list[str]) -> tuple[list[tuple[int, int]], int|None]:
+    """
+    Точні відбитки [(kind, hash)] — кожного вкладення і нормалізованого тексту —
+    та SimHash тексту для пошуку майже однакових постів (None, якщо тексту замало).
+    """
+    exact = [(FP_MEDIA, hash64(m)) for m in media_ids]
+    # Посилання та @згадки зазвичай різні в кожного каналу-джерела
+    words = re.findall(r"\w+", re.sub(r"https?://\S+|@\w+", " ", text.casefold()))
+    normalized = " ".join(words)
+    if len(normalized) < DEDUP_MIN_TEXT:
+        return exact, None
+    exact.append((FP_TEXT, hash64(normalized)))
+    return exact, simhash(words)
+
+
+class DuplicateFilter:
+    """
+    Придушення дублікатів для target'ів груп з увімкненим dedup (для такого target'а
+    перевіряються пости з усіх груп, що в нього пересилають): відбитки надісланих постів
+    живуть DEDUP_WINDOW секунд в обмеженому (DEDUP_MAX_ENTRIES) сховищі у пам'яті,
+    найстаріші витісняються першими. Нові відбитки пачками дописуються в dedup_fingerprints,
+    тож після рестарту вікно дедуплікації зберігається.
+    """
+
+    def __init__(self):
+        self.enabled: set[int] = set()                              # group_id з увімкненим dedup
+        self.entries: OrderedDict[tuple[str, int, int], float] = OrderedDict()  # (target, kind, value) -> expires_at
+        self.bands: dict[tuple[str, int, int], set[int]] = {}      # смуга SimHash -> повні значення
+        self.dirty: list[tuple[str, int, int, float]] = []
+        self.task: asyncio.Task|None = None
+        self.cached_targets: tuple[tuple[int, int], set[str]] = ((-1, -1), set())
+        self.enabled_version = 0
+
+    def enable(self, group_id: int, enabled: bool):
+        self.enabled_version += 1
+        if enabled:
+            self.enabled.add(group_id)
+        else:
+            self.enabled.discard(group_id)
+
+    def targets(self) -> set[str]:
+        """Target'и з увімкненим dedup; перераховуються лише після змін груп чи target'ів."""
+        version = (routing.version, self.enabled_version)
+        if self.cached_targets[0] != version:
+            targets = {routing.groups[g][1] for g in self.enabled if g in routing.groups}
+            self.cached_targets = (version, targets - {None})
+        return self.cached_targets[1]
+
+    def load(self, conn: sqlite3.Connection):
+        self.enabled = {row[0] for row in conn.execute("SELECT id FROM groups WHERE dedup=1")}
+        self.enabled_version += 1
+        rows = conn.execute("""
+            SELECT target, kind, value, expires_at FROM dedup_fingerprints
+             WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?
+        """, (time.time(), DEDUP_MAX_ENTRIES)).fetchall()
+        for (target, kind, value, expires_at) in reversed(rows):
+            self._put((target, kind, value & MASK64 if kind == FP_SIMHASH else value), expires_at)
+        logger.info("Дедуплікація: %d груп, %d відбитків.", len(self.enabled), len(self.entries))
+
+    def _put(self, key: tuple[str, int, int], expires_at: float):
+        self.entries[key] = expires_at
+        self.entries.move_to_end(key)
+        if key[1] == FP_SIMHASH:
+            for band in simhash_bands(key[0], key[2]):
+                self.bands.setdefault(band, set()).add(key[2])
+
+    def _evict(self, now: float):
+        while self.entries:
+            key, expires_at = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= DEDUP_MAX_ENTRIES:
+                break
+            del self.entries[key]
+            if key[1] == FP_SIMHASH:
+                for band in simhash_bands(key[0], key[2]):
+                    values = self.bands.get(band)
+                    if values is not None:
+                        values.discard(key[2])
+                        if not values:
+                            del self.bands[band]
+
+    def check(self, target: str, exact: list[tuple[int, int]], sim: int|None) -> bool:
+        """True, якщо такий пост уже надсилався в target; інакше запам'ятовує його відбитки."""
+        now = time.time()
+        self._evict(now)
+        if any((target, kind, value) in self.entries for (kind, value) in exact):
+            return True
+        if sim is not None:
+            for band in simhash_bands(target, sim):
+                for other in self.bands.get(band, ()):
+                    if (sim ^ other).bit_count() <= DEDUP_SIMHASH_DISTANCE:
+                        return True
+            exact = exact + [(FP_SIMHASH, sim)]
+        expires_at = now + DEDUP_WINDOW
+        for (kind, value) in exact:
+            self._put((target, kind, value), expires_at)
+            self.dirty.append((target, kind, value, expires_at))
+        return False
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(DEDUP_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Дедуплікація: не вдалося зберегти відбитки")
+
+    async def flush(self):
+        """Дописує нові відбитки в базу і прибирає прострочені."""
+        rows, self.dirty = self.dirty, []
+        now = time.time()
+
+        def op(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO dedup_fingerprints (target, kind, value, expires_at) VALUES (?, ?, ?, ?)",
+                [
+                    # SimHash беззнаковий — у базу кладемо як знакове 64-бітне
+                    (target, kind, value - (1 << 64) if value > MASK64 >> 1 else value, expires_at)
+                    for (target, kind, value, expires_at) in rows
+                ]
+            )
+            conn.execute("DELETE FROM dedup_fingerprints WHERE expires_at <= ?", (now,))
+
+        await db.run(op)
+
+
+duplicates = DuplicateFilter()
+
+
 # ------------------------------------------------------------------------------------
 #               ОБРОБНИК ПОВІДОМЛЕНЬ ІЗ КАНАЛІВ (пересилання постів)
 # ------------------------------------------------------------------------------------
+# Скільки пам'ятаємо вже поставлені пересилання (захист від повторної доставки апдейтів)
+RECENT_FORWARDS_TTL = 600.0
+RECENT_FORWARDS_MAX = 50_000
+
+
+class TTLCache:
+    """Обмежений за розміром і часом життя набір ключів (найстаріші витісняються першими)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()     # ключ -> час, коли запис застаріє
+
+    def add(self, key) -> bool:
+        """Додає ключ; повертає False, якщо ключ уже є і ще не застарів."""
+        now = time.monotonic()
+        while self.data:
+            oldest, expires = next(iter(self.data.items()))
+            if expires > now and len(self.data) < self.maxsize:
+                break
+            del self.data[oldest]
+        if key in self.data:
+            return False
+        self.data[key] = now + self.ttl
+        return True
+
+
+recent_forwards = TTLCache(RECENT_FORWARDS_MAX, RECENT_FORWARDS_TTL)
+
+
+# Скільки секунд чекаємо на решту повідомлень альбому після останнього отриманого
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))
+ALBUM_MAX_SIZE = 10         # більше елементів в альбомі Telegram не допускає
+
+
+class AlbumCollector:
+    """
+    Кожне фото/відео альбому приходить окремим channel_post з однаковим media_group_id.
+    Збираємо їх у коротке вікно (ALBUM_WINDOW після останнього елемента) і ставимо в outbox
+    однією задачею на ціль — тоді альбом пересилається одним forward_messages і не розпадається.
+    """
+
+    def __init__(self):
+        # (канал, media_group_id) -> ([message_id], {group_id: (name, target)}, [підписи], {типи}, [file_unique_id])
+        self.pending: dict[tuple[int, str], tuple[list[int], dict, list[str], set[str], list[str]]] = {}
+        self.usernames: dict[tuple[int, str], str|None] = {}
+        self.timers: dict[tuple[int, str], asyncio.TimerHandle] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def add(self, channel_id: int, media_group_id: str, msg_id: int,
+            groups: list[tuple[int, str, str]], text: str, kinds: set[str], media_ids: list[str],
+            username: str|None = None):
+        key = (channel_id, media_group_id)
+        self.usernames[key] = username
+        msg_ids, album_groups, texts, album_kinds, album_media = self.pending.setdefault(
+            key, ([], {}, [], set(), [])
+        )
+        msg_ids.append(msg_id)
+        for (g_id, g_name, g_target) in groups:
+            album_groups.setdefault(g_id, (g_name, g_target))
+        if text:
+            texts.append(text)
+        album_kinds |= kinds
+        album_media += media_ids
+
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if len(msg_ids) >= ALBUM_MAX_SIZE:
+            self._flush(key)
+        else:
+            self.timers[key] = asyncio.get_running_loop().call_later(ALBUM_WINDOW, self._flush, key)
+
+    def _flush(self, key: tuple[int, str]):
+        self.timers.pop(key, None)
+        msg_ids, groups, texts, kinds, media_ids = self.pending.pop(key)
+        username = self.usernames.pop(key, None)
+        targets = route_targets(
+            [(g_id, *group) for (g_id, group) in groups.items()], "\n".join(texts), kinds, media_ids
+        )
+        if not targets:
+            return
+        task = asyncio.create_task(enqueue_forwards(key[0], sorted(msg_ids), targets, username))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush_all(self):
+        """При зупинці: негайно ставимо в чергу всі незавершені альбоми."""
+        for key in list(self.pending):
+            self.timers[key].cancel()
+            self._flush(key)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+albums = AlbumCollector()
+
+
+@observe(HANDLER_LATENCY)
 async def channel_post_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Коли приходить повідомлення з каналу,
     перевіряємо, чи належить цей канал одній або кільком групам.
     Якщо так – пересилаємо у їхній target, якщо він заданий.
     """
+    POSTS_RECEIVED.inc()
     channel_id = update.channel_post.chat.id
     username = update.channel_post.chat.username  # None, якщо приватний канал без username
     msg_id = update.channel_post.message_id
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # Один пошук в індексі замість проходу по всіх групах у базі
+    groups = []
+    for (g_id, g_name, g_target) in routing.lookup(channel_id, username):
+        if g_target:
+            groups.append((g_id, g_name, g_target))
+        else:
+            forward_log.debug("[Group: %s] Target не задано, не пересилаємо.", g_name)
+    if not groups:
+        return
+    chat_cache.observe(update.channel_post.chat)
+
+    post = update.channel_post
+    text = post.text or post.caption or ""
+    media_group_id = post.media_group_id
+    if media_group_id:
+        # Фільтри застосовуємо до альбому цілком (підписи й типи всіх елементів)
+        albums.add(
+            channel_id, media_group_id, msg_id, groups, text, post_kinds(post), post_media_ids(post), username
+        )
+    else:
+        targets = route_targets(groups, text, post_kinds(post), post_media_ids(post))
+        if targets:
+            await enqueue_forwards(channel_id, [msg_id], targets, username)
 
-    # Витягаємо всі групи (у всіх користувачів)
-    c.execute("SELECT id, name, target_channel FROM groups")
-    all_groups = c.fetchall()
 
-    for (g_id, g_name, g_target) in all_groups:
-        # Перевіряємо, чи в group_channels є канал = channel_id (str) або = @username
-        c.execute("""
-            SELECT COUNT(*) FROM group_channels
-             WHERE group_id=?
-               AND (channel=? OR channel=?)
-        """, (g_id, str(channel_id), f"@{username}" if username else "_no_username_"))
-        (count_chan,) = c.fetchone()
-
-        if count_chan > 0:
-            # Цей канал входить до групи g_id
-            if g_target:
-                try:
-                    await context.bot.forward_message(
-                        chat_id=g_target,
-                        from_chat_id=channel_id,
-                        message_id=msg_id
-                    )
-                    logger.info(f"[Group: {g_name}] Переслано з {channel_id} до {g_target}.")
-                except Exception as e:
-                    logger.error(f"[Group: {g_name}] Помилка пересилання: {e}")
-            else:
-                logger.info(f"[Group: {g_name}] Target не задано, не пересилаємо.")
+def route_targets(groups: list[tuple[int, str, str]], text: str, kinds: set[str],
+                  media_ids: list[str]) -> dict[str, list[str]]:
+    """
+    Відсіює групи, чиї фільтри відкидають пост, і групує решту за target.
+    Кілька груп можуть мати спільний target — пересилаємо туди лише один раз.
+    Пости в target'и, для яких хоча б одна група увімкнула dedup, перевіряємо на дублікати.
+    """
+    allowed = content_filters.allowed((g_id for (g_id, _, _) in groups), text, kinds)
+    targets: dict[str, list[str]] = {}
+    for (g_id, g_name, g_target) in groups:
+        if g_id in allowed:
+            targets.setdefault(g_target, []).append(g_name)
+        else:
+            forward_log.debug("[Group: %s] Пост відкинуто фільтрами групи.", g_name)
+
+    dedup_targets = duplicates.targets().intersection(targets) if duplicates.enabled else ()
+    if dedup_targets:
+        exact, sim = post_fingerprints(text, media_ids)
+        for target in dedup_targets:
+            if duplicates.check(target, exact, sim):
+                g_names = ", ".join(targets.pop(target))
+                forward_log.debug("[Groups: %s] Дублікат уже надісланого в %s поста, пропущено.", g_names, target)
+    return targets
 
-    conn.close()
+
+async def enqueue_forwards(channel_id: int, msg_ids: list[int], targets: dict[str, list[str]],
+                           username: str|None = None):
+    """
+    Ставить пересилання msg_ids до кожної унікальної цілі в outbox (хендлер далі не чекає);
+    для цілей у режимі дайджесту — у буфер дайджесту.
+    """
+    jobs = []
+    debug = forward_log.isEnabledFor(logging.DEBUG)
+    for (g_target, g_names) in targets.items():
+        # Відкидаємо повідомлення, які Telegram доставив повторно
+        fresh = [m for m in msg_ids if recent_forwards.add((channel_id, m, g_target))]
+        if not fresh:
+            forward_log.debug("[Target: %s] Пост %s з %d вже в черзі, повтор пропущено.", g_target, msg_ids, channel_id)
+            continue
+        jobs.append((channel_id, fresh, g_target))
+        if debug:
+            forward_log.debug("[Groups: %s] Пост %s з %d поставлено в чергу до %s.",
+                              ", ".join(g_names), fresh, channel_id, g_target)
+
+    digest_targets = digests.targets() if digests.settings else {}
+    await digests.add([job for job in jobs if job[2] in digest_targets], username)
+    await outbox.enqueue([job for job in jobs if job[2] not in digest_targets])
+
+
+# ------------------------------------------------------------------------------------
+#               ОБРОБКА АПДЕЙТІВ (паралельно між чатами, по черзі в межах чату)
+# ------------------------------------------------------------------------------------
+
+# Скільки апдейтів обробляється одночасно і скільки може чекати своєї черги (далі — backpressure)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))
+
+
+def update_order_key(update) -> tuple|None:
+    """Апдейти з однаковим ключем обробляються строго по черзі (чат; для апдейтів без чату — користувач)."""
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейти різних чатів обробляються паралельно (не більше max_concurrent одночасно),
+    а в межах одного чату чи розмови — строго в порядку надходження: кожен апдейт чекає
+    завершення попереднього з тим самим ключем, не займаючи слот обробки.
+    Тож повільний канал не блокує адмінські розмови й інші канали.
+    Власний семафор admission обмежує кількість прийнятих в обробку апдейтів (max_pending).
+    Зворотного тиску він не дає: Application одразу створює задачу на кожен апдейт,
+    тож понад ліміт апдейти висять задачами на семафорі. Їх рахує admitting
+    і вони входять у unichannel_updates_pending.
+    """
+
+    def __init__(self, max_concurrent: int, max_pending: int):
+        limit = max(max_pending, max_concurrent, 2)
+        super().__init__(limit)
+        # Свій семафор замість приватного семафора базового класу: process_update перевизначено
+        self.admission = asyncio.Semaphore(limit)
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.tails: dict[tuple, asyncio.Future] = {}    # ключ -> future останнього апдейту цього ключа
+        self.admitting = 0      # задачі, що чекають на admission
+        self.pending = 0        # прийняті, що чекають своєї черги в чаті або слоту
+        self.running = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_update(self, update, coroutine):
+        # Як у базовому класі, але на власному семафорі й з лічильником задач, що на ньому чекають
+        self.admitting += 1
+        try:
+            await self.admission.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        finally:
+            self.admitting -= 1
+        try:
+            await self.do_process_update(update, coroutine)
+        finally:
+            self.admission.release()
+
+    async def do_process_update(self, update, coroutine):
+        admitted = time.perf_counter()
+        key = update_order_key(update)
+        previous = done = None
+        if key is not None:
+            previous = self.tails.get(key)
+            done = self.tails[key] = asyncio.get_running_loop().create_future()
+
+        self.pending += 1
+        try:
+            try:
+                if previous is not None:
+                    # asyncio.wait, а не await previous: скасування цієї задачі не скасує чужий future
+                    await asyncio.wait((previous,))
+                await self.slots.acquire()
+            except BaseException:
+                coroutine.close()
+                raise
+            finally:
+                self.pending -= 1
+
+            UPDATE_WAIT.observe(time.perf_counter() - admitted)
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.slots.release()
+        finally:
+            if done is not None:
+                if previous is not None and not previous.done():
+                    # Скасовано до настання черги: наступний апдейт чату все одно має чекати на попередній
+                    previous.add_done_callback(lambda _: self._release(key, done))
+                else:
+                    self._release(key, done)
+
+    def _release(self, key: tuple, done: asyncio.Future):
+        done.set_result(None)
+        if self.tails.get(key) is done:
+            del self.tails[key]
+
+
+update_processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
 
 
 # ------------------------------------------------------------------------------------
 #                          ГОЛОВНА ФУНКЦІЯ
 # ------------------------------------------------------------------------------------
-def main():
-    init_db()
+async def post_init(app: Application):
+    app.bot_data["metrics_server"] = await start_metrics_server()
+    forwarder.start(app.bot)
+    target_health.start(app.bot)
+    chat_cache.start(app.bot)
+    outbox.start()
+    duplicates.start()
+    digests.start()
+    # Резолв старих @username-рядків не блокує старт: до його завершення діють текстові ключі.
+    # Звичайна задача, а не app.create_task: Application ще не запущено, тож за нею стежимо самі
+    app.bot_data["legacy_migration"] = asyncio.create_task(resolve_legacy_channels(app.bot))
+
+async def post_stop(app: Application):
+    # post_stop, а не post_shutdown: бот ще може надсилати запити, тож черги встигнуть спорожніти
+    migration = app.bot_data.pop("legacy_migration", None)
+    if migration is not None:
+        # Недороблена міграція продовжиться при наступному старті
+        migration.cancel()
+        results = await asyncio.gather(migration, return_exceptions=True)
+        if isinstance(results[0], Exception):
+            logger.error("Міграція каналів завершилась помилкою: %r", results[0])
+    await albums.flush_all()
+    await digests.stop()
+    await outbox.stop()
+    await duplicates.stop()
+    await chat_cache.stop()
+    server = app.bot_data.get("metrics_server")
+    if server:
+        server.close()
+    profiler.stop()
+
+
+# Режим отримання апдейтів: "polling" (за замовчуванням) або "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "webhook")
+# Публічна адреса для setWebhook, напр. https://example.com/webhook (за замовчуванням — listen:port/path)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Telegram передає його в заголовку X-Telegram-Bot-Api-Secret-Token, інші запити отримують 403
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Альтернативний Bot API сервер (локальний stub для тестів без мережі), напр. http://127.0.0.1:8081/bot
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
 
-    app = Application.builder().token(BOT_TOKEN).build()
+
+def main():
+    db.run_sync(init_db)
+    db.run_sync(routing.warm_start)
+    db.run_sync(chat_cache.load)
+    db.run_sync(content_filters.load)
+    db.run_sync(duplicates.load)
+    db.run_sync(digests.load)
+    db.run_sync(Outbox.recover)
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    app = builder.build()
 
     # Створюємо ConversationHandler зі станами
     conv_handler = ConversationHandler(
@@ -508,7 +3981,7 @@ def main():
             MAIN_MENU: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, main_menu_handler),
                 # Обробник inline-кнопок у тому ж стані:
-                CallbackQueryHandler(select_group_callback, pattern=r"^selectgroup\|.+$"),
+                CallbackQueryHandler(select_group_callback, pattern=r"^(sg\|\d+|selectgroup\|.+)$"),
             ],
             ADDING_GROUP: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, adding_group)
@@ -528,17 +4001,54 @@ def main():
             SETTING_TARGET: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, setting_target)
             ],
+            EDITING_FILTERS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, editing_filters)
+            ],
+            SETTING_DIGEST: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, setting_digest)
+            ],
         },
 
-        fallbacks=[CommandHandler("cancel", cmd_cancel)]
+        fallbacks=[CommandHandler("cancel", cmd_cancel)],
+        # Стани зберігаються у channels.db (SQLitePersistence) і відновлюються після рестарту
+        name="main",
+        persistent=True,
     )
     app.add_handler(conv_handler)
 
+    # Гортання сторінок списків не змінює стан розмови, тож працює з будь-якого стану
+    app.add_handler(CallbackQueryHandler(page_callback, pattern=r"^(gp|lg|cp\|\d+)\|[<>]\|\d+$"))
+
+    # Масовий імпорт/експорт груп (працює незалежно від стану розмови)
+    app.add_handler(CommandHandler("export", cmd_export, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("import", cmd_import, filters=filters.ChatType.PRIVATE))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.ChatType.PRIVATE, import_document))
+
+    # Зміни прав бота в чатах (додали, вилучили, зробили адміном) — одразу в кеш чатів
+    app.add_handler(ChatMemberHandler(my_chat_member_handler, ChatMemberHandler.MY_CHAT_MEMBER))
+
     # Обробляємо пости з каналів
     app.add_handler(MessageHandler(filters.ALL & filters.ChatType.CHANNEL, channel_post_handler))
 
-    logger.info("Бот запущено. Очікуємо повідомлення...")
-    app.run_polling()
+    logger.info("Бот запущено (%s). Очікуємо повідомлення...", BOT_MODE)
+    try:
+        # В обох режимах зупинка (SIGINT/SIGTERM) проходить через post_stop,
+        # тож альбоми та outbox встигають спорожнитись до закриття бази.
+        if BOT_MODE == "webhook":
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            app.run_polling()
+    finally:
+        # Наступний старт підхопить індекс зі знімка, якщо таблиці відтоді не змінювались
+        db.run_sync(routing.save_snapshot)
+        db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+"""
+Локальна перевірка webhook-режиму без мережі.
+
+Скрипт піднімає stub Bot API (відповідає на getMe/setWebhook/forwardMessage(s)...),
+POST-ить записані Update JSON (по одному на рядок) на локальний webhook бота
+і міряє end-to-end затримку: від POST апдейту до виклику forwardMessage(s) у stub'і.
+
+Приклад:
+    # 1) у першому терміналі
+    python replay_updates.py updates.jsonl --secret S3CRET
+    # 2) у другому терміналі
+    BOT_TOKEN=1:stub BOT_MODE=webhook WEBHOOK_LISTEN=127.0.0.1 WEBHOOK_PORT=8443 \\
+    WEBHOOK_SECRET=S3CRET BOT_API_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+
+Ліміти scheduler'а діють і тут: щоб міряти саму затримку, а не rate limiting,
+підніміть FORWARD_TARGET_RATE_PER_MIN / FORWARD_TARGET_BURST для бота.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+STUB_USER = {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+
+# (from_chat_id, message_id) -> час, коли stub отримав пересилання
+forwarded: dict[tuple[int, int], float] = {}
+forwarded_lock = threading.Lock()
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    """Мінімальний Bot API: повертає правдоподібні відповіді й записує пересилання."""
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        params = self._parse(raw)
+
+        if method == "getMe":
+            result = STUB_USER
+        elif method in ("forwardMessage", "forwardMessages"):
+            from_chat_id = int(params.get("from_chat_id", 0))
+            if method == "forwardMessage":
+                message_ids = [int(params.get("message_id", 0))]
+            else:
+                message_ids = [int(m) for m in json.loads(params.get("message_ids", "[]"))]
+            now = time.perf_counter()
+            with forwarded_lock:
+                for mid in message_ids:
+                    forwarded.setdefault((from_chat_id, mid), now)
+            chat = {"id": 0, "type": "channel"}
+            if method == "forwardMessage":
+                result = {"message_id": message_ids[0], "date": int(time.time()), "chat": chat}
+            else:
+                result = [{"message_id": mid} for mid in message_ids]
+        else:
+            # setWebhook, deleteWebhook тощо
+            result = True
+
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parse(self, raw: bytes) -> dict:
+        ctype = self.headers.get("Content-Type", "")
+        if "json" in ctype:
+            return {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(raw or b"{}").items()}
+        return dict(parse_qsl(raw.decode()))
+
+    def log_message(self, *args):
+        pass
+
+
+def post_update(url: str, secret: str|None, payload: bytes) -> int:
+    req = urllib.request.Request(url, data=payload, method="POST")
+    req.add_header("Content-Type", "application/json")
+    if secret:
+        req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def wait_for_webhook(url: str, timeout: float):
+    """Чекаємо, доки бот підніме webhook-сервер (будь-яка HTTP-відповідь підходить)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"Webhook {url} не відповідає за {timeout} с")
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay записаних Update JSON на локальний webhook")
+    parser.add_argument("updates", help="файл з Update JSON, по одному на рядок")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8443/webhook")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--stub-port", type=int, default=8081)
+    parser.add_argument("--wait", type=float, default=60.0, help="скільки чекати старту бота")
+    parser.add_argument("--settle", type=float, default=5.0, help="скільки чекати на пересилання після POST")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.stub_port), StubBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Stub Bot API: http://127.0.0.1:{args.stub_port}/bot")
+
+    wait_for_webhook(args.webhook, args.wait)
+
+    sent: dict[tuple[int, int], float] = {}
+    with open(args.updates, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            post = update.get("channel_post") or {}
+            started = time.perf_counter()
+            status = post_update(args.webhook, args.secret, line.encode())
+            if status != 200:
+                print(f"update_id={update.get('update_id')}: HTTP {status}")
+                continue
+            if post:
+                sent[(post["chat"]["id"], post["message_id"])] = started
+
+    deadline = time.monotonic() + args.settle
+    while time.monotonic() < deadline and not sent.keys() <= forwarded.keys():
+        time.sleep(0.05)
+    server.shutdown()
+
+    latencies = [(forwarded[key] - t) * 1000 for key, t in sent.items() if key in forwarded]
+    print(f"Надіслано постів: {len(sent)}, переслано: {len(latencies)}")
+    if latencies:
+        print(f"Затримка, мс: p50={statistics.median(latencies):.1f} "
+              f"p99={percentile(latencies, 0.99):.1f} max={max(latencies):.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError
+
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def health(monkeypatch):
+    health = bot.TargetHealth()
+    monkeypatch.setattr(bot, "target_health", health)
+    monkeypatch.setattr(bot, "HEALTH_FAILURE_THRESHOLD", 3)
+    return health
+
+
+@pytest.fixture
+def outbox_db():
+    bot.db.run_sync(bot.init_db)
+    bot.db.run_sync(lambda conn: conn.execute("DELETE FROM outbox"))
+    return bot.db
+
+
+def add_rows(conn, target: str, count: int, attempts: int = 0) -> list[int]:
+    ids = []
+    for i in range(count):
+        ids.append(conn.execute(
+            "INSERT INTO outbox (source_chat, message_id, target, attempts, created_at) VALUES (-1, ?, ?, ?, 0)",
+            (i + 1, target, attempts)
+        ).lastrowid)
+    return ids
+
+
+def outbox_row(row_id: int):
+    return bot.db.run_sync(lambda conn: conn.execute(
+        "SELECT status, attempts, next_attempt_at, last_error FROM outbox WHERE id=?", (row_id,)
+    ).fetchone())
+
+
+# --- TargetHealth ---
+def test_transient_failures_open_circuit_at_threshold(health):
+    for _ in range(2):
+        health.record("-1", NetworkError("timeout"))
+    assert health.admit("-1") == "send"
+    health.record("-1", NetworkError("timeout"))
+    circuit = health.circuits["-1"]
+    assert circuit.state == "open"
+    assert circuit.backoff == bot.HEALTH_BACKOFF_BASE
+    assert 0.8 * circuit.backoff <= circuit.retry_at - time.time() <= 1.2 * circuit.backoff
+    assert health.admit("-1") == "defer"
+    assert health.defer_until("-1") == circuit.retry_at
+
+
+def test_success_resets_failure_count(health):
+    health.record("-1", NetworkError("timeout"))
+    health.record("-1", NetworkError("timeout"))
+    health.record("-1", None)
+    health.record("-1", NetworkError("timeout"))
+    assert health.circuits["-1"].state == "closed"
+    assert health.circuits["-1"].failures == 1
+
+
+def test_probe_failure_doubles_backoff_and_success_closes(health):
+    for _ in range(3):
+        health.record("-1", NetworkError("timeout"))
+    circuit = health.circuits["-1"]
+
+    circuit.retry_at = 0            # backoff минув
+    assert health.admit("-1") == "send"
+    assert circuit.state == "probing"
+    assert health.admit("-1") == "defer"        # лише одна пробна відправка
+    health.record("-1", NetworkError("timeout"))
+    assert circuit.state == "open"
+    assert circuit.backoff == 2 * bot.HEALTH_BACKOFF_BASE
+
+    circuit.retry_at = 0
+    assert health.admit("-1") == "send"
+    health.record("-1", None)
+    assert "-1" not in health.circuits
+    assert health.admit("-1") == "send"
+
+
+def test_cancelled_probe_reopens(health):
+    for _ in range(3):
+        health.record("-1", NetworkError("timeout"))
+    health.circuits["-1"].retry_at = 0
+    health.admit("-1")
+    health.record("-1", asyncio.CancelledError())
+    assert health.circuits["-1"].state == "open"
+
+
+def test_post_specific_error_does_not_count(health):
+    health.record("-1", BadRequest("Message to forward not found"))
+    assert "-1" not in health.circuits
+
+
+def run_verify(health, monkeypatch, unwritable):
+    failed = []
+
+    async def fake_unwritable(bot_, target):
+        return unwritable(target)
+
+    async def fake_fail(target, reason):
+        failed.append((target, reason))
+
+    monkeypatch.setattr(bot, "target_unwritable", fake_unwritable)
+    monkeypatch.setattr(health, "_fail", fake_fail)
+
+    async def main():
+        health.record("-1", Forbidden("bot was kicked from the channel chat"))
+        assert health.circuits["-1"].state == "checking"
+        assert health.admit("-1") == "defer"
+        await asyncio.gather(*health.tasks)
+    asyncio.run(main())
+    return failed
+
+
+def test_permanent_error_confirmed_disables_target(health, monkeypatch):
+    failed = run_verify(health, monkeypatch, lambda target: "бот не має права публікувати")
+    assert health.circuits["-1"].state == "failed"
+    assert health.admit("-1") == "drop"
+    assert failed == [("-1", "бот не має права публікувати")]
+    health.reset("-1")
+    assert health.admit("-1") == "send"
+
+
+def test_permanent_error_not_confirmed_counts_as_transient(health, monkeypatch):
+    failed = run_verify(health, monkeypatch, lambda target: None)
+    circuit = health.circuits["-1"]
+    assert circuit.state == "closed"
+    assert circuit.failures == 1
+    assert failed == []
+
+
+def test_permanent_error_check_failure_opens_circuit(health, monkeypatch):
+    def unwritable(target):
+        raise NetworkError("timeout")
+    failed = run_verify(health, monkeypatch, unwritable)
+    assert health.circuits["-1"].state == "open"
+    assert failed == []
+
+
+# --- Outbox ---
+def test_claim_honours_per_target_inflight_cap(monkeypatch):
+    monkeypatch.setattr(bot, "OUTBOX_TARGET_INFLIGHT", 5)
+    conn = sqlite3.connect(":memory:")
+    bot.init_db(conn)
+    add_rows(conn, "-1", 12)
+    add_rows(conn, "-2", 3)
+
+    rows, more = bot.Outbox._claim(conn, 100, {})
+    targets = [row[3] for row in rows]
+    assert targets.count("-1") == 5 and targets.count("-2") == 3
+    assert not more
+
+    # У forwarder'і вже 4 задачі цілі -1: лишається один слот; -2 повністю зайнята
+    conn.execute("UPDATE outbox SET status='pending'")
+    rows, _ = bot.Outbox._claim(conn, 100, {"-1": 4, "-2": 5})
+    assert [row[3] for row in rows] == ["-1"]
+
+    (inflight,) = conn.execute("SELECT COUNT(*) FROM outbox WHERE status='inflight'").fetchone()
+    assert inflight == 1
+
+
+def test_claim_reports_more_when_limit_reached():
+    conn = sqlite3.connect(":memory:")
+    bot.init_db(conn)
+    add_rows(conn, "-1", 2)
+    add_rows(conn, "-2", 2)
+    rows, more = bot.Outbox._claim(conn, 3, {})
+    assert len(rows) == 3 and more
+
+
+def test_failed_attempts_retry_then_dead(outbox_db, health, monkeypatch):
+    monkeypatch.setattr(bot, "OUTBOX_MAX_ATTEMPTS", 2)
+    (row_id,) = outbox_db.run_sync(add_rows, "-1", 1)
+    box = bot.Outbox()
+
+    async def deliver(error):
+        attempts = outbox_row(row_id)[1]
+        box.inflight[row_id] = (attempts, "-1")
+        box.busy["-1"] = 1
+        box.results.append((row_id, error))
+        await box._apply_results()
+
+    asyncio.run(deliver(NetworkError("timeout")))
+    status, attempts, next_attempt_at, last_error = outbox_row(row_id)
+    assert (status, attempts) == ("pending", 1)
+    assert next_attempt_at > time.time()
+    assert "timeout" in last_error
+    assert box.busy == {} and box.inflight == {}
+
+    asyncio.run(deliver(NetworkError("timeout")))
+    assert outbox_row(row_id)[:2] == ("dead", 2)
+
+
+def test_success_deletes_row(outbox_db, health):
+    (row_id,) = outbox_db.run_sync(add_rows, "-1", 1)
+    box = bot.Outbox()
+    box.inflight[row_id] = (0, "-1")
+    box.busy["-1"] = 2
+    box.results.append((row_id, None))
+    asyncio.run(box._apply_results())
+    assert outbox_row(row_id) is None
+    assert box.busy == {"-1": 1}
+
+
+def test_hold_defers_without_spending_attempts(outbox_db):
+    ids = outbox_db.run_sync(add_rows, "-1", 2, 3)
+    outbox_db.run_sync(lambda conn: conn.execute("UPDATE outbox SET status='inflight'"))
+    later = time.time() + 60
+    outbox_db.run_sync(bot.Outbox._hold, [(later, ids[0])], [("ціль -1 недоступна", ids[1])])
+    assert outbox_row(ids[0])[:3] == ("pending", 3, later)
+    assert outbox_row(ids[1])[0] == "dead"
+    assert outbox_row(ids[1])[3] == "ціль -1 недоступна"
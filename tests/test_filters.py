@@ -0,0 +1,157 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def brute_force(words: dict[int, str], text: str) -> set[int]:
+    return {rule_id for (rule_id, word) in words.items() if word in text}
+
+
+# --- AhoCorasick ---
+def test_aho_corasick_overlapping_words():
+    ac = bot.AhoCorasick()
+    for rule_id, word in enumerate(("he", "she", "his", "hers")):
+        ac.add(word, rule_id)
+    assert ac.search("ushers") == {0, 1, 3}
+    assert ac.search("ahishe") == {0, 1, 2}
+    assert ac.search("xyz") == set()
+
+
+def test_aho_corasick_shared_word_and_remove():
+    ac = bot.AhoCorasick()
+    ac.add("ціна", 1)
+    ac.add("ціна", 2)
+    ac.add("на", 3)
+    assert ac.search("нова ціна") == {1, 2, 3}
+    ac.remove("ціна", 1)
+    assert ac.search("нова ціна") == {2, 3}
+    ac.remove("відсутнє", 9)
+    assert ac.search("нова ціна") == {2, 3}
+
+
+def test_aho_corasick_add_after_search_relinks():
+    ac = bot.AhoCorasick()
+    ac.add("abc", 1)
+    assert ac.search("zabcd") == {1}
+    ac.add("bcd", 2)
+    ac.add("c", 3)
+    assert ac.search("zabcd") == {1, 2, 3}
+
+
+def test_aho_corasick_matches_brute_force():
+    rnd = random.Random(42)
+    for _ in range(200):
+        words = {i: "".join(rnd.choice("abc") for _ in range(rnd.randint(1, 4))) for i in range(rnd.randint(1, 8))}
+        ac = bot.AhoCorasick()
+        for rule_id, word in words.items():
+            ac.add(word, rule_id)
+        for _ in range(5):
+            text = "".join(rnd.choice("abcd") for _ in range(rnd.randint(0, 30)))
+            assert ac.search(text) == brute_force(words, text)
+        removed = rnd.choice(list(words))
+        ac.remove(words.pop(removed), removed)
+        text = "".join(rnd.choice("abc") for _ in range(30))
+        assert ac.search(text) == brute_force(words, text)
+
+
+# --- ContentFilters ---
+def test_keyword_match_is_case_insensitive():
+    f = bot.ContentFilters()
+    f.add_rule(1, 10, "keyword", "exclude", "Реклама")
+    assert f.match("Тут РЕКЛАМА каналу", {"text"}) == {1}
+    assert f.match("звичайний пост", {"text"}) == set()
+
+
+def test_regex_is_case_insensitive():
+    f = bot.ContentFilters()
+    f.add_rule(1, 10, "regex", "include", r"ціна\s*\d+")
+    assert f.match("Ціна 100 грн", {"text"}) == {1}
+    assert f.match("ціна договірна", {"text"}) == set()
+
+
+def test_regex_set_reports_every_matching_rule():
+    f = bot.ContentFilters()
+    f.add_rule(1, 10, "regex", "exclude", r"\d{3}-\d{2}")
+    f.add_rule(2, 11, "regex", "exclude", r"[@#]\pL+")
+    f.add_rule(3, 12, "regex", "exclude", r"^x")
+    assert f.match("тел 123-45 #тег", {"text"}) == {1, 2}
+    assert f.match("x", {"text"}) == {3}
+    assert f.match("", {"text"}) == set()
+
+
+def test_regex_set_rebuilds_after_remove():
+    f = bot.ContentFilters()
+    f.add_rule(1, 10, "regex", "exclude", r"\d{3}")
+    f.add_rule(2, 10, "regex", "exclude", r"[@#]\w+")
+    assert f.match("123 #tag", {"text"}) == {1, 2}
+    f.remove_rule(1)
+    assert f.match("123 #tag", {"text"}) == {2}
+    f.remove_rule(2)
+    assert f.regexes == {}
+    assert f.match("123 #tag", {"text"}) == set()
+
+
+def test_media_rules():
+    f = bot.ContentFilters()
+    f.add_rule(1, 10, "media", "exclude", "photo")
+    assert f.match("", {"photo"}) == {1}
+    assert f.match("текст", {"text"}) == set()
+
+
+def test_allowed_include_and_exclude():
+    f = bot.ContentFilters()
+    f.add_rule(1, 10, "keyword", "include", "новини")
+    f.add_rule(2, 10, "keyword", "exclude", "реклама")
+    f.add_rule(3, 11, "media", "exclude", "video")
+    groups = {10, 11, 12}
+    assert f.allowed(groups, "свіжі новини", {"text"}) == {10, 11, 12}
+    assert f.allowed(groups, "новини і реклама", {"text"}) == {11, 12}
+    assert f.allowed(groups, "інше", {"video"}) == {12}
+    f.remove_group(10)
+    assert f.allowed(groups, "інше", {"text"}) == {10, 11, 12}
+
+
+def test_load_skips_regex_unsupported_by_re2():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE group_filters (id INTEGER PRIMARY KEY, group_id INTEGER, kind TEXT, mode TEXT, pattern TEXT)")
+    conn.executemany(
+        "INSERT INTO group_filters VALUES (?, ?, ?, ?, ?)",
+        [(1, 10, "regex", "exclude", r"(?=spam)"), (2, 10, "keyword", "exclude", "spam")],
+    )
+    f = bot.ContentFilters()
+    f.load(conn)
+    assert set(f.rules) == {2}
+
+
+def test_backtracking_patterns_run_in_linear_time():
+    f = bot.ContentFilters()
+    patterns = [r"(a+)+!", r".*a.*b", r"\d+\d+x", r"x.*y"] + [rf"[a-z]+\d+z{i}" for i in range(20)]
+    for rule_id, pattern in enumerate(patterns):
+        assert bot.validate_regex(pattern) is None
+        f.add_rule(rule_id, 10, "regex", "exclude", pattern)
+    for text in ("a" * 4000, "1" * 4000, "x" * 4000):
+        started = time.perf_counter()
+        assert f.match(text, {"text"}) == set()
+        assert time.perf_counter() - started < 0.1
+
+
+# --- validate_regex ---
+@pytest.mark.parametrize("pattern", [r"ціна\s*\d+", r"\w+@\w+\.\w+", r"(foo|bar)+!", r"^\d{3}-\d{2}$", r"#\pL+"])
+def test_validate_regex_accepts(pattern):
+    assert bot.validate_regex(pattern) is None
+
+
+@pytest.mark.parametrize("pattern", [r"(a)\1", r"(?=x)", r"(?<!x)y", r"[unclosed"])
+def test_validate_regex_rejects_unsupported(pattern):
+    assert bot.validate_regex(pattern)